@@ -20,59 +20,150 @@
 #	mRNA.tRNA = B (bound complex)
 #	mRNA.tRNA* = EB (excited bound complex)
 import numpy as np
-def kinetic_proofreading():
-        
+import sim_library as sl
+
+# The rates that kinetic_proofreading() sweeps: bF, and five values each of
+# bR, eF, eR and dF. bR2 is the wrong tRNA's bR for each bR; both tRNAs
+# have dR = bR.
+def sweep_rates():
     bF = 1
     bR = np.array([0.0001, 0.001, 0.01, 0.1, 1])
     eF = np.array([0.0001, 0.001, 0.01, 0.1, 1])
     eR = np.array([0, .001, .01, .1, 1])
     dF = np.array([0, .001, .01, .1, 1])
     bR2 = np.array([0.01, 0.1, 1, 10, 100])
+    return (bF, bR, eF, eR, dF, bR2)
+
+# Sweep every combination of the rates below (on all of the CPUs, using
+# sim_sweep), comparing the final [EB] for the right tRNA (bR, dR) against a
+# wrong one (bR2, dR2), and print the largest ratio.
+def kinetic_proofreading():
+    import sim_sweep as ssw
+        
+    bF, bR, eF, eR, dF, bR2 = sweep_rates()
     dR = bR; dR2 = bR2
-    b = 0 
+    points1 = []; points2 = []
     for i in range(5):
         for n in range(5):
             for m in range(5):
                 for d in range(5):
-                    [final_EB1,OK1] = sim (bF, bR[i], eF[n], eR[m], dF[d], dR[i])
-                    [final_EB2,OK2] = sim (bF, bR2[i], eF[n], eR[m], dF[d], dR2[i])
-                    a = final_EB1/final_EB2
-                    if a >= 9900:
-                        print(bF, bR[i], eF[n], eR[m], dF[d], dR[i])
-                    if a > b:
-                        b = a # find the largest ratio
+                    points1.append (dict (bF=bF, bR=bR[i], eF=eF[n], eR=eR[m],
+                                          dF=dF[d], dR=dR[i]))
+                    points2.append (dict (bF=bF, bR=bR2[i], eF=eF[n], eR=eR[m],
+                                          dF=dF[d], dR=dR2[i]))
+    res1 = ssw.run_sweep (build, points1, ['EB'], 2000)
+    res2 = ssw.run_sweep (build, points2, ['EB'], 2000)
+
+    b = 0 
+    for p1,p2 in zip (res1, res2):
+        a = p1['EB']/p2['EB']
+        if a >= 9900:
+            print(bF, p1['bR'], p1['eF'], p1['eR'], p1['dF'], p1['dR'])
+        if a > b:
+            b = a # find the largest ratio
     print(b)
     
-    return (final_EB1,OK1)
-
+    return (res1['EB'][-1], res1['OK'][-1])
+
+# The steady-state [B] and [EB], without simulating. With [mRNA] and [tRNA]
+# held constant (so that the binding and Edecay drives are the constants
+# bF*mRNA*tRNA and dF*mRNA*tRNA), the network is linear in B and EB:
+#	dB/dt  = bF*mRNA*tRNA - (bR+eF)*B + eR*EB
+#	dEB/dt = dF*mRNA*tRNA + eF*B - (eR+dR)*EB
+# Setting both to 0 gives a 2x2 linear system per set of rates. The rates
+# may be arrays (which broadcast against each other), and then every
+# system gets stacked into one array and solved by one np.linalg.solve().
+# Its determinant is bR*eR + bR*dR + eF*dR, so it is solvable whenever bR
+# and dR are positive.
+# Returns (B, EB), each with the broadcast shape of the rates.
+def steady_state (bF, bR, eF, eR, dF, dR, mRNA=1, tRNA=1):
+    bF, bR, eF, eR, dF, dR = np.broadcast_arrays (bF, bR, eF, eR, dF, dR)
+    A = np.empty (bR.shape + (2,2))
+    A[...,0,0] = -(bR+eF); A[...,0,1] = eR
+    A[...,1,0] = eF;       A[...,1,1] = -(eR+dR)
+    drive = np.stack ((bF, dF), axis=-1) * (mRNA*tRNA)
+    x = np.linalg.solve (A, -drive[...,np.newaxis])[...,0]
+    return (x[...,0], x[...,1])
+
+# kinetic_proofreading()'s whole sweep, from steady_state() instead of 1250
+# simulations. Returns the ratio of the right tRNA's [EB] to the wrong one's
+# as a 5x5x5x5 array, indexed [bR, eF, eR, dF] like sweep_rates() (so
+# ratio[i,n,m,d] is kinetic_proofreading()'s point (i,n,m,d)), and prints
+# its largest value.
+# To make sure that the algebra still matches the network, 'check' randomly
+# chosen points (of both tRNAs) also get built and run to steady state the
+# way the sweep does them, and compared; a relative difference over 'rtol'
+# raises a RuntimeError. steady_state_sim() stops once every level moves by
+# <1% over the last 10% of the run, so on the slowest points it falls a few
+# percent short of the true steady state; hence the default rtol.
+def kinetic_proofreading_linear (check=8, rtol=.05, seed=0):
+    import sim_infrastructure as si
+    bF, bR, eF, eR, dF, bR2 = sweep_rates()
+    # Index every rate by [i,n,m,d].
+    bR  = bR [:,None,None,None]; bR2 = bR2[:,None,None,None]
+    eF  = eF [None,:,None,None]; eR  = eR [None,None,:,None]
+    dF  = dF [None,None,None,:]
+    B1,EB1 = steady_state (bF, bR, eF, eR, dF, bR)
+    B2,EB2 = steady_state (bF, bR2, eF, eR, dF, bR2)
+    ratio = EB1 / EB2
+
+    rng = np.random.default_rng (seed)
+    worst = 0
+    for k in rng.choice (ratio.size, size=min (check, ratio.size),
+                         replace=False):
+        i,n,m,d = np.unravel_index (k, ratio.shape)
+        for bRx,EB in ((bR, EB1), (bR2, EB2)):
+            rates = (bF, bRx[i,0,0,0], eF[0,n,0,0], eR[0,0,m,0],
+                     dF[0,0,0,d], bRx[i,0,0,0])
+            net = si.Network()
+            build (net, *rates)
+            t,y,OK = net.steady_state_sim (2000)
+            final_EB = net.final_val (y, 'EB')
+            diff = abs (final_EB - EB[i,n,m,d]) / abs (EB[i,n,m,d])
+            if ((not OK) or (diff > rtol)):
+                raise RuntimeError ('kinetic_proofreading_linear: at rates '
+                                    + str(rates) + ' the simulation gave EB='
+                                    + str(final_EB) + ' but the algebra gave '
+                                    + str(EB[i,n,m,d]))
+            worst = max (worst, diff)
+    if (check):
+        print ('Checked', min (check, ratio.size), 'points by simulation;',
+               'largest relative difference', worst)
+    print (ratio.max())
+    return (ratio)
+
+# Add the proofreading metabolites and reactions to the network 'net'.
+def build (net, bF, bR, eF, eR, dF, dR):
+    # Add metabolites here.
+    net.add_metab('mRNA', 1); net.add_metab('tRNA', 1)
+    net.add_metab('B', 1); net.add_metab('EB', 1)
+    
 
+    # The library's mass-action gates do the same thing as binding(),
+    # exciting() and Edecay() below, but get vectorized by the simulator.
+    net.add_reaction (sl.mass_action_held,'binding', ['mRNA','tRNA'], ['B'], [bF,bR])
+    net.add_reaction (sl.mass_action,'exciting', ['B'], ['EB'], [eF,eR])
+    net.add_reaction (sl.mass_action_held,'Edecay', ['mRNA','tRNA'], ['EB'], [dF,dR])
+    # net.add_reaction (product,'product',['EB','prod'],['prod','EB'], [pF pR])
 
 def sim (bF, bR, eF, eR, dF, dR):
     import sim_infrastructure as si
     si.clear_sim()
     final_EB=0		# In case the sim does not converge.
-
-    # Add metabolites here.
-    si.add_metab('mRNA', 1); si.add_metab('tRNA', 1)
-    si.add_metab('B', 1); si.add_metab('EB', 1)
-    
-
-    si.add_reaction (binding,'binding', ['mRNA','tRNA'], ['B'], [bF,bR])
-    si.add_reaction (exciting,'exciting', ['B'], ['EB'], [eF,eR])
-    si.add_reaction (Edecay,'Edecay', ['mRNA','tRNA'], ['EB'], [dF,dR])
-    # si.add_reaction (product,'product',['EB','prod'],['prod','EB'], [pF pR])
+    build (si.g_default, bF, bR, eF, eR, dF, dR)
 
     [t,y,OK] = si.steady_state_sim (2000)
     final_EB = si.final_val (y, 'EB')
     return (final_EB,OK)
 
 ######################################################
+# The same reactions, as hand-written reaction functions. Each one checks its
+# shape just once, when add_reaction() calls its prepare hook, so the calls
+# during a simulation do nothing but arithmetic.
 
 # reaction binding: inputs=mRNA, tRNA; outputs=B; params=bF, bR.
 #	1. binding: mRNA + tRNA <-> mRNA.tRNA (bF, bR)
 def binding(t, inputs, outputs, params):
-    import sim_library as sl
-    sl.checkInputs ('binding', 2,1,2, inputs, outputs, params)
     mRNA,tRNA = inputs
     [B] = outputs
     bF,bR = params
@@ -80,43 +171,45 @@ def binding(t, inputs, outputs, params):
     # Note that we do not assign any flow on the inputs; they are assumed to
     # have constant concentration.
     return ([[], [bF*mRNA*tRNA - bR*B]])
+binding.prepare = sl.check_once ('binding', 2,1,2, binding)
 
 # reaction exciting: inputs=B; outputs=EB; params=eR, eF.
 #	2. exciting: mRNA.tRNA <-> mRNA.tRNA* (eF, eR)
 def exciting(t, inputs, outputs, params):
-    import sim_library as sl
-    sl.checkInputs ('exciting', 1,1,2, inputs, outputs, params)
     [B]  = inputs
     [EB] = outputs
     eF,eR = params
 
     d = eF*B - eR*EB	# d(EB)/dt
     return ([[-d], [d]])
+exciting.prepare = sl.check_once ('exciting', 1,1,2, exciting)
 
 # reaction Edecay; inputs=mRNA, tRNA; outputs=EB, params=dF, dR.
 #	3. Edecay: mRNA.tRNA* <-> mRNA + tRNA (dR, dF)
 def Edecay(t, inputs, outputs, params):
-    import sim_library as sl
-    sl.checkInputs ('Edecay', 2,1,2, inputs, outputs, params)
     mRNA,tRNA = inputs
     [EB] = outputs
     dF,dR=params
     return ([[], [dF*mRNA*tRNA - dR*EB]])
+Edecay.prepare = sl.check_once ('Edecay', 2,1,2, Edecay)
 
 # reaction product; inputs=EB, product; outputs=product,EB, params=pF, pR.
 #	4. product: mRNA.tRNA* <-> product (pF, pR)
 def product(t, inputs, outputs, params):
-    import sim_library as sl
-    sl.checkInputs ('product', 2,1,2, inputs, outputs, params)
     EB,product = inputs
     pF,pR=params
 
     d = pF*EB - pR*product
     return ([[], [d,-d]])
-
-
-import time
-start = time.clock()
-final_EB1,OK1 = kinetic_proofreading()
-end = time.clock()
-print ("Total time: %f s" % (end - start))
\ No newline at end of file
+product.prepare = sl.check_once ('product', 2,1,2, product)
+
+
+if __name__ == '__main__':
+    import time, sys
+    start = time.perf_counter()
+    if ('--linear' in sys.argv):
+        kinetic_proofreading_linear()
+    else:
+        final_EB1,OK1 = kinetic_proofreading()
+    end = time.perf_counter()
+    print ("Total time: %f s" % (end - start))
\ No newline at end of file
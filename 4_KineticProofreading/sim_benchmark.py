@@ -0,0 +1,237 @@
+########################################
+# Benchmarks for sim_infrastructure, on generated networks of growing size.
+# run_benchmarks (out='sim_benchmark.json', sizes=(10,100,1000,10000),
+#		  quick=False, seed=0)
+#	Builds and simulates each of
+#	- chain:  a chain of n sim_library.inv1 inverters, driven by a
+#		  constant input.
+#	- ring:   a ring of n inv1 inverters (n made odd), which oscillates, so
+#		  it gets no steady_state_sim().
+#	- kp:	  the kinetic-proofreading network (one size only).
+#	- random: a random reversible mass-action network with n metabolites.
+#	The inverter networks stop at 1000 inverters, since every inv1 is a
+#	separate Python call. With quick=True, every size is capped at 100.
+#	Every case uses the default method='auto' (so BDF and the sparse
+#	Jacobian above sim_infrastructure.SPARSE_METABS metabolites, and LSODA
+#	below), and records which one that was.
+#	Each case runs in its own process, one at a time, and records
+#	- compile_s:	 seconds to build and compile the network.
+#	- rhs_per_s:	 derivative evaluations per second.
+#	- run_sim_s:	 wall time for run_sim().
+#	- steady_s:	 wall time for steady_state_sim(), and steady_OK.
+#	- peak_rss_mb:	 the process's peak memory (and start_rss_mb, its memory
+#			 before building the network, for comparison).
+#	A case that fails records its 'error' instead, and the rest carry on.
+#	The results go to the JSON file 'out', along with the versions of
+#	Python, numpy and scipy, and the git commit if there is one.
+#	Returns the same dict that it saved.
+# compare_benchmarks (old, new, threshold=1.2)
+#	Print every time in the JSON file 'new' that is more than 'threshold'
+#	times the same case's time in 'old' (and every rate that fell by as
+#	much). Returns the list of those regressions.
+#
+# From the command line:
+#	python sim_benchmark.py [out.json] [--quick]
+#	python sim_benchmark.py --compare old.json new.json
+########################################
+
+import numpy as np
+
+# inv1 parameters: kP, kDP, kD, kDN, n. A gain this high makes odd rings
+# oscillate.
+INV_PARAMS = [20, 1, 1, 1, 4]
+
+# A chain of n inverters: in -> x1 -> x2 -> ... -> xn.
+def build_chain (net, n, seed=0):
+    import sim_library as sl
+    net.add_metab ('in', 0)
+    for i in range(n):
+        net.add_metab ('x'+str(i), 0)
+    net.add_reaction (sl.constDriver, 'drive', [], ['in'], [0])
+    prev = 'in'
+    for i in range(n):
+        net.add_reaction (sl.inv1, 'inv'+str(i), [prev], ['x'+str(i)],
+                          list (INV_PARAMS))
+        prev = 'x'+str(i)
+
+# A ring of n inverters (n odd). Start it off-balance so that it oscillates.
+def build_ring (net, n, seed=0):
+    import sim_library as sl
+    n = n | 1
+    for i in range(n):
+        net.add_metab ('x'+str(i), 20.0 if (i==0) else 0.0)
+    for i in range(n):
+        net.add_reaction (sl.inv1, 'inv'+str(i), ['x'+str(i)],
+                          ['x'+str((i+1)%n)], list (INV_PARAMS))
+
+def build_kp (net, n=4, seed=0):
+    import kinetic_proofreading as kp
+    kp.build (net, 1, .01, .1, .01, .001, .01)
+
+# A random reversible mass-action network with n metabolites and about 2n
+# reactions: half are conversions A <-> B and half associations A + B <-> C,
+# with rate constants spread log-uniformly over [.1, 10]. Each reaction picks
+# its metabolites from within 'window' of each other (in index order); like a
+# real metabolic network, and unlike a fully random graph, that keeps the
+# Jacobian's LU factors sparse, so the large sizes stay feasible.
+def build_random (net, n, seed=0, window=10):
+    import sim_library as sl
+    rng = np.random.default_rng (seed)
+    names = ['m'+str(i) for i in range(n)]
+    for name,init in zip (names, rng.random (n)):
+        net.add_metab (name, float(init))
+    for j in range(2*n):
+        k = 10**rng.uniform (-1, 1, size=2)
+        w = min (window, n)
+        m = (rng.integers (n) + rng.choice (w, size=3, replace=False)) % n
+        ins = [names[m[0]]] if (j%2 == 0) else [names[m[0]], names[m[1]]]
+        net.add_reaction (sl.mass_action, 'r'+str(j), ins, [names[m[2]]],
+                          [float(k[0]), float(k[1])])
+
+BUILDERS = {'chain':build_chain, 'ring':build_ring, 'kp':build_kp,
+            'random':build_random}
+
+# The process's peak memory so far, in MB (or None where we cannot tell).
+def peak_rss_mb():
+    try:
+        import resource, sys
+    except ImportError:
+        return (None)
+    peak = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes.
+    return (peak / (1024*1024 if (sys.platform == 'darwin') else 1024))
+
+# Time repeated calls of f() for at least 'min_s' seconds; calls per second.
+def rate (f, min_s=.2):
+    import time
+    n = 0; start = time.perf_counter()
+    while (True):
+        f(); n += 1
+        elapsed = time.perf_counter() - start
+        if (elapsed >= min_s):
+            return (n / elapsed)
+
+# Run one benchmark case; this is what runs in the child processes.
+# 'case' is (kind, size, tEnd, seed).
+def bench_case (case):
+    import time
+    import sim_infrastructure as si
+    # Import everything up front, so that no case gets timed importing it.
+    import scipy.integrate, scipy.sparse, scipy.linalg, scipy.optimize
+    import sim_library, kinetic_proofreading
+    kind, size, tEnd, seed = case
+    res = {'case':kind, 'size':size, 'start_rss_mb':peak_rss_mb()}
+    try:
+        net = si.Network()
+        start = time.perf_counter()
+        BUILDERS[kind] (net, size, seed)
+        comp = net.compile()
+        res['compile_s'] = time.perf_counter() - start
+        res['n_metabs'] = len(net.metabs)
+        res['n_reactions'] = len(net.reactions)
+
+        res['method'] = net.pick_method ('auto')
+
+        y = np.array (net.metab_initVal, dtype=float)
+        res['rhs_per_s'] = rate (lambda: comp.rhs (y, 0))
+
+        start = time.perf_counter()
+        net.run_sim (tEnd, 100)
+        res['run_sim_s'] = time.perf_counter() - start
+
+        if (kind != 'ring'):	# a ring has no steady state
+            start = time.perf_counter()
+            t,y,OK = net.steady_state_sim (tEnd, mode='continue')
+            res['steady_s'] = time.perf_counter() - start
+            res['steady_OK'] = bool (OK)
+    except Exception as e:
+        res['error'] = type(e).__name__ + ': ' + str(e)
+    res['peak_rss_mb'] = peak_rss_mb()
+    return (res)
+
+# The list of cases for run_benchmarks().
+def benchmark_cases (sizes, quick, seed):
+    if (quick):
+        sizes = [s for s in sizes if (s <= 100)]
+    cases = [('kp', 4, 2000, seed)]
+    for size in sizes:
+        if (size <= 1000):
+            cases.append (('chain', size, 100, seed))
+            cases.append (('ring', size, 100, seed))
+        cases.append (('random', size, 100, seed))
+    return (cases)
+
+# Versions and such, so that results from different runs can be told apart.
+def environment():
+    import sys, platform, datetime, subprocess, os
+    import scipy
+    env = {'python':sys.version.split()[0], 'numpy':np.__version__,
+           'scipy':scipy.__version__, 'platform':platform.platform(),
+           'date':datetime.datetime.now().isoformat (timespec='seconds')}
+    try:
+        env['git'] = subprocess.run (['git', 'rev-parse', 'HEAD'],
+                        cwd=os.path.dirname (os.path.abspath (__file__)),
+                        capture_output=True, text=True).stdout.strip()
+    except OSError:
+        pass
+    return (env)
+
+def run_benchmarks (out='sim_benchmark.json', sizes=(10,100,1000,10000),
+                    quick=False, seed=0):
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+    results = []
+    for case in benchmark_cases (sizes, quick, seed):
+        # A fresh process per case, so that peak_rss_mb is the case's own.
+        with ProcessPoolExecutor (1) as pool:
+            res = pool.submit (bench_case, case).result()
+        print (format_result (res))
+        results.append (res)
+    report = {'environment':environment(), 'results':results}
+    with open (out, 'w') as f:
+        json.dump (report, f, indent=1)
+    return (report)
+
+def format_result (res):
+    if ('error' in res):
+        return ('%-7s %6d  FAILED: %s' % (res['case'], res['size'],
+                                          res['error']))
+    steady = (' steady %8.3fs%s' % (res['steady_s'],
+                                    '' if res['steady_OK'] else ' (not OK)')
+              if ('steady_s' in res) else '')
+    return ('%-7s %6d  %9.0f rhs/s  run_sim %8.3fs%s  %6.0f MB'
+            % (res['case'], res['size'], res['rhs_per_s'], res['run_sim_s'],
+               steady, res['peak_rss_mb'] or 0))
+
+def compare_benchmarks (old, new, threshold=1.2):
+    import json
+    with open (old) as f:
+        before = {(r['case'], r['size']):r for r in json.load (f)['results']}
+    with open (new) as f:
+        after = json.load (f)['results']
+    regressions = []
+    for r in after:
+        b = before.get ((r['case'], r['size']))
+        if (b is None):
+            continue
+        for key in ('compile_s', 'run_sim_s', 'steady_s', 'rhs_per_s'):
+            if ((key not in r) or (key not in b)):
+                continue
+            # Times should not grow; rates should not shrink.
+            ratio = (r[key]/b[key]) if (key != 'rhs_per_s') else (b[key]/r[key])
+            if (ratio > threshold):
+                regressions.append ((r['case'], r['size'], key, b[key], r[key]))
+                print ('%-7s %6d %-10s %10.4g -> %10.4g (%.2fx worse)'
+                       % (r['case'], r['size'], key, b[key], r[key], ratio))
+    return (regressions)
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    if ((len(args) == 3) and (args[0] == '--compare')):
+        compare_benchmarks (args[1], args[2])
+    else:
+        quick = '--quick' in args
+        files = [a for a in args if not a.startswith ('--')]
+        run_benchmarks (files[0] if files else 'sim_benchmark.json',
+                        quick=quick)
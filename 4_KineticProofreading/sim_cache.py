@@ -0,0 +1,115 @@
+########################################
+# The memo behind sim_infrastructure.enable_steady_cache().
+# SteadyStateCache (max_entries=1024, disk_dir=None,
+#		    max_disk_bytes=256*1024*1024)
+#	Maps a key (a Network.content_key()) to a steady_state_sim() result,
+#	in memory and optionally in 'disk_dir' too. enable_steady_cache()
+#	makes one, and steady_state_sim() consults it through get() and
+#	put(); stats() is what steady_cache_stats() returns. Disk entries are
+#	written atomically (see sim_infrastructure.write_atomic()), so any
+#	number of threads and processes may share one directory.
+########################################
+
+import threading
+import numpy as np
+import sim_infrastructure as si
+
+# Memoized steady_state_sim() results, keyed by Network.content_key().
+# The memory tier holds the 'max_entries' most recently used results. With a
+# 'disk_dir', results also go there, one pickle per key, so that they survive
+# the process (and are shared with other processes using the same
+# directory); when the directory grows past 'max_disk_bytes', the least
+# recently used files go first.
+class SteadyStateCache:
+    def __init__ (self, max_entries=1024, disk_dir=None,
+                  max_disk_bytes=256*1024*1024):
+        import collections
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0; self.disk_hits = 0; self.misses = 0
+        if (disk_dir is not None):
+            import os
+            os.makedirs (disk_dir, exist_ok=True)
+
+    def file_name (self, key):
+        import os
+        return (os.path.join (self.disk_dir, 'ss-'+key+'.pkl'))
+
+    # The cached result for 'key', or None.
+    def get (self, key):
+        with self.lock:
+            if (key in self.memory):
+                self.memory.move_to_end (key)
+                self.hits += 1
+                return (copy_result (self.memory[key]))
+        if (self.disk_dir is not None):
+            import os, pickle
+            try:
+                with open (self.file_name (key), 'rb') as f:
+                    value = pickle.load (f)
+                os.utime (self.file_name (key))	# for least-recently-used
+            except (OSError, EOFError, pickle.UnpicklingError):
+                value = None
+            if (value is not None):
+                with self.lock:
+                    self.disk_hits += 1
+                    self.remember (key, value)
+                return (copy_result (value))
+        with self.lock:
+            self.misses += 1
+        return (None)
+
+    def put (self, key, value):
+        value = copy_result (value)
+        with self.lock:
+            self.remember (key, value)
+        if (self.disk_dir is not None):
+            # The memory tier has it anyway, so a failed write only costs
+            # the disk tier this entry.
+            import pickle
+            if (si.write_atomic (self.file_name (key), lambda f: pickle.dump (
+                                         value, f, pickle.HIGHEST_PROTOCOL))):
+                self.evict_disk()
+
+    # Add to the memory tier, dropping the least recently used if it's full.
+    def remember (self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end (key)
+        while (len(self.memory) > self.max_entries):
+            self.memory.popitem (last=False)
+
+    def evict_disk (self):
+        import os, glob
+        files = []
+        for name in glob.glob (os.path.join (self.disk_dir, 'ss-*.pkl')):
+            try:
+                st = os.stat (name)
+            except OSError:
+                continue		# another process evicted it
+            files.append ((st.st_mtime, st.st_size, name))
+        total = sum (f[1] for f in files)
+        for mtime,size,name in sorted (files):
+            if (total <= self.max_disk_bytes):
+                break
+            try:
+                os.remove (name)
+            except OSError:
+                pass
+            total -= size
+
+    def stats (self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return ({'hits':self.hits, 'disk_hits':self.disk_hits,
+                     'misses':self.misses, 'entries':len(self.memory),
+                     'hit_rate':((self.hits+self.disk_hits)/lookups
+                                 if lookups else 0.0)})
+
+# A copy of a steady_state_sim() result tuple, so that a caller who changes
+# the arrays it got does not change the cache.
+def copy_result (value):
+    return (tuple (v.copy() if isinstance (v, np.ndarray) else v
+                   for v in value))
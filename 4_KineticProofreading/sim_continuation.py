@@ -0,0 +1,238 @@
+########################################
+# Transfer curves by numerical continuation, for the networks built with
+# sim_infrastructure.
+# run_xfer_continuation (inName, Cmax, outName, sideInputNames,
+#			 sideInputVals, max_step=.1, net=None)
+#	The transfer curve of sim_infrastructure.run_xfer_curve() for the
+#	network 'net' (by default, the one that add_metab() and add_reaction()
+#	built), traced by numerical continuation: each point starts from the
+#	previous steady state, and the step size adapts to the curve, so the
+#	steep parts get more points and the flat parts fewer. It returns four
+#	values, xUp, yUp, xDown, yDown: the curve as the input sweeps slowly
+#	up from 0 to Cmax, and then back down. Where the network is bistable,
+#	each sweep follows its branch until the branch ends and then jumps,
+#	so the two differ (hysteresis); the network's xfer_folds lists where
+#	they jumped. Network.run_xfer_continuation() and the module-level
+#	sim_infrastructure.run_xfer_continuation() call this.
+#
+# Finding the steady states takes the conservation laws of the compiled
+# network, i.e., a dense SVD of its stoichiometry, so this does not scale to
+# the largest networks the way run_sim() does.
+########################################
+
+import numpy as np
+import sim_infrastructure as si
+
+# Pseudo-arclength continuation of the steady states of 'net' as one of its
+# rate constants, lam = net.kF[j], varies. It's meant for a constant driver
+# (as in run_xfer_continuation()), so lam is the level that the driver holds
+# its metabolite at; 'span' is the range of lam that we care about, and 'y0'
+# the initial state (which fixes the conserved totals).
+# The curve is a path u(s) = (y(s), lam(s)) where the steady-state equations
+# F(y,lam)=0 hold (with the conservation laws in place of redundant rows, as in
+# steady_state_root()). From each point we step 'ds' along the tangent, and
+# then pull back onto the curve with Newton's method, keeping the step
+# perpendicular to the tangent. Since that follows the curve by its length
+# rather than by lam, it goes around folds, where lam turns back.
+# Lengths are measured relative to 'span' for lam, and to the largest value
+# seen so far for each metabolite, so the steps adapt to the curve's shape
+# in those terms: they grow while Newton converges quickly, and shrink when
+# it fails or when the tangent turns by more than 'max_turn' radians. The
+# longest step is max_step.
+class Continuation:
+    def __init__ (self, net, j, y0, span, max_step=.1, max_turn=.2,
+                  tEndGuess=100, breaks=()):
+        self.net = net; self.j = j
+        self.breaks = breaks	# for settle(); see integrate()
+        self.L, self.pivots = net.conservation_laws()
+        self.target = self.L @ y0
+        self.y0 = y0; self.span = span; self.tEndGuess = tEndGuess
+        self.max_step = max_step; self.min_cos = np.cos (max_turn)
+        self.scale = np.append (np.abs (y0), span)
+        self.rescale (y0)
+        # dF/dlam: the driver adds lam (times its stoichiometry) to F.
+        self.dFdlam = net.stoich_column (j)
+        self.dFdlam[self.pivots] = 0
+        self.folds = []; self.solves = 0
+
+    def F (self, y, lam):
+        self.net.kF[self.j] = lam
+        g = self.net.rhs (y, self.tEndGuess)
+        g[self.pivots] = self.L @ y - self.target
+        return (g)
+
+    def J (self, y, lam):
+        self.net.kF[self.j] = lam
+        J = self.net.jacobian_dense (y, self.tEndGuess)
+        J[self.pivots] = self.L
+        return (J)
+
+    # Let the scale of each metabolite grow to cover the state 'u'. Changes
+    # that are tiny next to the biggest metabolite do not matter to the
+    # curve's shape, so no scale goes below a tenth of the biggest one (or of
+    # the span, while everything is still 0).
+    def rescale (self, u):
+        self.scale[:len(u)] = np.maximum (self.scale[:len(u)], np.abs(u))
+        biggest = np.max (self.scale[:-1], initial=0)
+        floor = .1 * (biggest if (biggest > 0) else self.span)
+        self.scale[:-1] = np.maximum (self.scale[:-1], floor)
+
+    # The scaled inner product that lengths and angles are measured in.
+    def dot (self, a, b):
+        return (np.sum (a*b/self.scale**2))
+
+    def stable (self, u):
+        self.net.kF[self.j] = u[-1]
+        return (si.is_stable (self.net.jacobian_dense (u[:-1], self.tEndGuess),
+                           self.L))
+
+    # The unit tangent at u, oriented to agree with 'prev'.
+    def tangent (self, u, prev):
+        A = np.vstack ((np.column_stack ((self.J (u[:-1], u[-1]), self.dFdlam)),
+                        prev/self.scale**2))
+        b = np.zeros (len(u)); b[-1] = 1
+        self.solves += 1
+        t = np.linalg.solve (A, b)
+        return (t / np.sqrt (self.dot (t,t)))
+
+    # Newton's method for F(y,lam)=0 at a fixed lam.
+    # Returns None if it does not converge.
+    def newton_fixed (self, y, lam):
+        y = y.copy()
+        for it in range(20):
+            self.solves += 1
+            try:
+                dy = np.linalg.solve (self.J (y, lam), -self.F (y, lam))
+            except np.linalg.LinAlgError:
+                return (None)
+            y += dy
+            if (np.all (np.abs(dy) <= 1e-10*self.scale[:-1])):
+                return (y)
+        return (None)
+
+    # Newton's method for F=0 plus <tau, u-pred> = 0, from the predicted point
+    # 'pred'. Returns (u, iterations), or None if it does not converge.
+    def corrector (self, pred, tau):
+        u = pred.copy()
+        for it in range(1, 9):
+            y, lam = u[:-1], u[-1]
+            r = np.append (self.F (y, lam), self.dot (tau, u-pred))
+            A = np.vstack ((np.column_stack ((self.J (y, lam), self.dFdlam)),
+                            tau/self.scale**2))
+            self.solves += 1
+            try:
+                du = np.linalg.solve (A, -r)
+            except np.linalg.LinAlgError:
+                return (None)
+            u += du
+            if (np.all (np.abs(du) <= 1e-10*self.scale)):
+                return (u, it)
+        return (None)
+
+    # Integrate to a steady state at 'lam', from 'y'; then polish it.
+    def settle (self, y, lam):
+        self.net.kF[self.j] = lam
+        tEnd,Y,OK = si.ensemble_steady_state (self.net, y[np.newaxis],
+                                              self.tEndGuess,
+                                              breaks=self.breaks)
+        polished = self.newton_fixed (Y[0], lam)
+        return (Y[0] if (polished is None) else polished)
+
+    # Follow the stable steady states from lam0 to lam1, as a slow sweep of
+    # the input would, starting from state 'y' (or, by default, wherever the
+    # network settles from y0). Where the branch folds back or turns
+    # unstable, home in on that point and then jump: integrate from just
+    # past it to whichever steady state the network falls into, and carry on
+    # from there. Returns a list of (lam, y) pairs.
+    def sweep (self, lam0, lam1, y=None):
+        d = 1 if (lam1 > lam0) else -1
+        y = self.settle (self.y0 if (y is None) else y, lam0)
+        u = np.append (y, lam0)
+        self.rescale (u)
+        points = [(lam0, y)]
+        along = np.zeros (len(u)); along[-1] = d
+        tau = self.tangent (u, along)
+        ds = self.max_step/4
+        min_ds = 1e-4*self.max_step	# how closely we locate a fold
+
+        while (True):
+            res = self.corrector (u + ds*tau, tau)
+            if (res is not None):
+                u_new, iters = res
+                tau_new = self.tangent (u_new, tau)
+                cos = self.dot (tau, tau_new) / np.sqrt (self.dot (tau, tau))
+                past_end = ((u_new[-1] - lam1)*d >= 0)
+                # (A step past the end may go negative; e.g., the input
+                # itself does, past lam=0.)
+                ok = ((cos >= self.min_cos) and (past_end or np.all (
+                                    u_new[:-1] >= -1e-9*self.scale[:-1])))
+            if ((res is None) or not ok):
+                if (ds <= 1e-8*self.max_step):
+                    raise RuntimeError ('Continuation stalled at input '
+                                        +str(u[-1]))
+                ds /= 2
+                continue
+
+            # Past the end: finish exactly at lam1.
+            if (past_end):
+                f = (lam1 - u[-1]) / (u_new[-1] - u[-1])
+                guess = u[:-1] + f*(u_new[:-1] - u[:-1])
+                y = self.newton_fixed (guess, lam1)
+                points.append ((lam1, self.settle (guess, lam1)
+                                if (y is None) else y))
+                return (points)
+
+            # Did the branch fold back (or lose stability)? Then take smaller
+            # steps to find where, and jump.
+            if ((tau_new[-1]*d <= 0) or not self.stable (u_new)):
+                if (ds > min_ds):
+                    ds /= 2
+                    continue
+                lam = u[-1] + d*1e-3*self.span
+                self.folds.append ((d, u[-1]))
+                y = self.settle (u[:-1], lam)
+                u = np.append (y, lam)
+                self.rescale (u)
+                points.append ((lam, y))
+                tau = self.tangent (u, along)
+                ds = self.max_step/4
+                continue
+
+            u = u_new; tau = tau_new
+            self.rescale (u)
+            points.append ((u[-1], u[:-1].copy()))
+            if (iters <= 3):
+                ds = min (ds*1.5, self.max_step)
+
+# Compute a transfer curve by numerical continuation, rather than by
+# re-simulating evenly-spaced points from scratch.
+# The inputs are as for run_xfer_curve(), but with no nPoints: the steps
+# adapt to the curve instead (see Continuation), at most 'max_step' long.
+# Outputs: xUp, yUp, xDown, yDown; the transfer curve as the main input
+#	sweeps slowly up from 0 to Cmax, and then back down. Where the
+#	network is bistable, the two sweeps fall off their branches at
+#	different inputs, and the curves differ (hysteresis).
+# It also sets net.xfer_folds to a list of the (direction, input) where the
+# sweeps jumped from one branch to another (direction is +1 going up), and
+# net.xfer_solves to how many linear solves it took.
+def run_xfer_continuation (inName, Cmax, outName, sideInputNames,
+                           sideInputVals, max_step=.1, net=None):
+    net = si.g_default if (net is None) else net
+    comp, main = net.xfer_network (inName, sideInputNames, sideInputVals)
+    out_numb = net.metab_number (outName)
+    cont = Continuation (comp, comp.fast.index(main),
+                         np.array (net.metab_initVal, dtype=float),
+                         Cmax, max_step, breaks=net.breakpoints())
+    if (net.profile is not None):
+        net.profile.begin_run()
+    # Settling at the far end first tells the step control what sizes
+    # of change to expect.
+    cont.rescale (cont.settle (cont.y0, Cmax))
+    up = cont.sweep (0, Cmax)
+    down = cont.sweep (Cmax, 0, up[-1][1])
+    if (net.profile is not None):
+        net.profile.end_run()
+    net.xfer_folds = cont.folds
+    net.xfer_solves = cont.solves
+    return ([p[0] for p in up], [p[1][out_numb] for p in up],
+            [p[0] for p in down], [p[1][out_numb] for p in down])
@@ -13,15 +13,120 @@
 #	inputs: vector of names for the reactants.
 #	outputs: vector of names for the products (there can be more than one).
 #	parameters: vector of double for the instance parameters.
-# run_sim (tEnd, n_timepoints=10):
+# save_network (path)
+#	Write the whole network (metabolites, initial values and reactions) to
+#	one file: JSON if 'path' ends in '.json' (readable, and easy to write
+#	by hand or from another program), and otherwise a compact numpy .npz
+#	file. Reaction functions are recorded by module and name (e.g.,
+#	'sim_library.mass_action'), so they must be module-level functions.
+# load_network (path)
+#	Replace the network with one from save_network()'s file, much faster
+#	than the add_metab()/add_reaction() calls that built it. The JSON
+#	format is
+#	  {"format": "sim_infrastructure network v1",
+#	   "gates": ["sim_library.mass_action", ...],
+#	   "metabs": ["A", "B", ...], "init": [1.0, 0.0, ...],
+#	   "reactions": [[gate, name, inputs, outputs, params], ...]}
+#	where each reaction's gate is an index into "gates", and its inputs
+#	and outputs are lists of metabolite names.
+#	Loading imports every module named in "gates" (to find the reaction
+#	functions), which runs that module's code, so only load files that
+#	you trust.
+# compile_sim (vectorize=True, cache_dir=None)
+#	Optional; call it after the last add_reaction(). It flattens every
+#	reaction that uses a mass-action gate from sim_library (mass_action,
+#	mass_action_held, constDriver) into index arrays and a stoichiometry
+#	matrix, so that each derivative evaluation handles all of them at once.
+#	Reactions with any other reaction function still get called one at a
+#	time. run_sim() calls it for you if the network changed since the last
+#	compile. With vectorize=False, every reaction is called one at a time.
+#	With a 'cache_dir', the compiled structure (index arrays,
+#	stoichiometry, Jacobian sparsity) is saved there, keyed by a hash of
+#	the network's topology. Compiling the same topology again, even from
+#	another script, loads it instead; changing the topology changes the
+#	hash. Later compiles (including run_sim()'s) keep using that cache_dir,
+#	even after clear_sim() or load_network() replaces the network.
+# run_sim (tEnd, n_timepoints=10, method='auto', rtol=None, atol=None,
+#	   sens=None, store=None, chunk=10000, events=None, stats=None):
 #	Run a simulation from t=0 to t=tEnd.
+#	'method' is 'LSODA' (scipy's odeint), or 'BDF' or 'Radau' for the
+#	implicit solvers from scipy.integrate.solve_ivp, which suit stiff
+#	networks. All of them get the analytic Jacobian from jacobian().
+#	The default, 'auto', is LSODA for networks of up to SPARSE_METABS
+#	(500) metabolites and BDF for larger ones. LSODA factors a dense
+#	Jacobian, which costs O(n^2) memory and O(n^3) time per factorization;
+#	BDF and Radau keep the Jacobian sparse (as is the compiled network's
+#	stoichiometry matrix), so for a network where each reaction touches a
+#	few metabolites, memory and the cost of each step grow roughly
+#	linearly with its size. That is what makes networks of 10k+
+#	metabolites practical.
 #	Return:
 #	- a 1D array of timepoints, containing n_timepoints evenly-spaced
 #	  values of time between 0 and tEnd (so if tEnd=2 and n_timepoints=5,
 #	  then it returns [0, .5, 1, 1.5, 2].
 #	- a 2D array of simulation results. Each row corresponds to one of the
 #	  above timepoints; each column corresponds to one reactant.
-# run_xfer_curve (inName, Cmax,outName, sideInputNames,sideInputVals,nPoints)
+#	- only if 'sens' is given: the sensitivity of the results to each of the
+#	  parameters listed in 'sens' as (reactionName, paramIndex) pairs; a 3D
+#	  array indexed [timepoint, metabolite, parameter].
+#	With 'events' (a list of Event objects), it also watches for each
+#	event as it integrates, and returns an extra value (last): for each
+#	event, an array of the times it happened. Each event's time is found
+#	by root finding as the solver steps past it, not from the output
+#	timepoints. A terminal event (the default) ends the run: the results
+#	stop at the last timepoint before it, plus one row for the event
+#	itself, so t[-1] is when it happened and y[-1] the state then.
+#	With 'store' (a directory name), the results go to disk instead,
+#	'chunk' timepoints at a time, and both arrays come back as read-only
+#	numpy memmaps. load_results(store) opens them again later; its
+#	.t, .y and .metabs are the timepoints, the results and the metabolite
+#	names, and final_val() accepts it in place of the results.
+#	With 'stats' (a SolverStats), each solver call adds its counts there.
+# SolverStats ()
+#	Collects the solvers' own statistics, to tell a simulation that is
+#	stiff or badly scaled from one that is merely long. Pass the same one
+#	as 'stats' to any number of run_sim(), steady_state_sim() and
+#	run_xfer_curve() calls, and each solver call they make adds to its
+#	totals: calls, rhs_evals, jac_evals, lu_decomps, steps, switches
+#	(between LSODA's non-stiff and stiff methods) and min_step/max_step.
+#	Its .runs list has the same counts for each call, and report() prints
+#	them. steady_state_sim() records every doubling of its horizon (or,
+#	with mode='root', the root finding too); run_xfer_curve() records each
+#	doubling of its ensemble, and sets .settle_times to the horizon by
+#	which each point had settled (inf if it never did). Not every solver
+#	reports everything; what it doesn't is None.
+# Event (metab, value, kind='level', direction=0, terminal=True)
+#	Something for run_sim() to watch for:
+#	- kind='level':  the metabolite named 'metab' crosses 'value'.
+#	- kind='rate':   its d/dt crosses 'value'.
+#	- kind='settle': the size of its d/dt falls below 'value'.
+#	'direction' is +1 to count only upward crossings, -1 only downward
+#	ones and 0 for both. A terminal event stops the simulation.
+# run_sim_reduced (tEnd, n_timepoints=10, method='auto', gap=100,
+#		   compare=True)
+#	run_sim() on a quasi-steady-state reduction of a stiff network; see
+#	sim_reduce.
+# run_ensemble (tEnd, n_timepoints=10, initVals=None, params=None,
+#		processes=1)
+#	Run many replicas of the network at once, as one vectorized system
+#	(so, one solver call rather than one per replica). Each replica may
+#	have its own initial values and reaction parameters:
+#	- initVals: a 2D array [replica, metabolite]; by default, every
+#	  replica starts from the values given to add_metab().
+#	- params: a dict from reaction name to a 2D array [replica, parameter]
+#	  of that reaction's parameters in each replica. Reactions that it
+#	  leaves out keep their own parameters in every replica.
+#	With processes > 1, the replicas are split between that many worker
+#	processes (each still integrating its share as one system), which
+#	helps with very large ensembles.
+#	Returns the timepoints (as for run_sim()) and a 3D array of results
+#	indexed [replica, timepoint, metabolite].
+# run_sim_chunks (tEnd, n_timepoints=10, method='auto', rtol=None,
+#		  atol=None, chunk=10000, stats=None)
+#	The same simulation as run_sim(), as a generator that yields
+#	(timepoints, results) for 'chunk' timepoints at a time.
+# run_xfer_curve (inName, Cmax,outName, sideInputNames,sideInputVals,nPoints,
+#		  stats=None)
 #	Computes a transfer curve. It sweeps the reactant 'inName' from 0 to
 #	'Cmax', and measures the resulting concentration of the product
 #	'outName'. You can also specify a vector of other reactants
@@ -31,7 +136,19 @@
 #	- a 1D array of the values 'inName' we evaluated at (i.e., 'nPoints'
 #	  evenly-spaced concentrations between 0 and 'Cmax'
 #	- a 1D array of the corresponding values of 'outName'.
-# steady_state_sim (tEndGuess)
+#	All of the points are simulated together, as one ensemble.
+#	'stats' is as for run_sim().
+# run_xfer_continuation (inName, Cmax, outName, sideInputNames,
+#			 sideInputVals, max_step=.1)
+#	The same transfer curve, traced by numerical continuation; see
+#	sim_continuation.
+# jacobian (y, t)
+#	Return d(yprime)/d(y) as a scipy.sparse matrix. Vectorized reactions are
+#	differentiated exactly; other reactions use their function's .jac hook
+#	if it has one (see sim_library), and are differentiated numerically
+#	otherwise.
+# steady_state_sim (tEndGuess, method='auto', mode='restart', sens=None,
+#		    stats=None)
 #	Simulates the current network until all metabolite levels are reasonably
 #	steady. You must have already used add_metab() to set any initial
 #       conditions and/or driving input reactants as needed.
@@ -43,29 +160,79 @@
 #	- a Boolean, telling whether we ever did reach steady state. If we
 #	  simulate until 100*tEndGuess and the metabolite levels are still
 #	  changing, we give up and return false.
+#	With mode='continue', each doubling of the simulated time continues
+#	from where the previous one stopped instead of starting over at t=0,
+#	and steadiness is judged from the derivatives (see is_steady()).
+#	With mode='root', it solves for the fixed point directly after a short
+#	integration, and falls back to mode='continue' if that fails.
+#	The network's steady_path (g_default.steady_path for these functions)
+#	then says which of the two ('root' or 'integrate') gave the answer.
+#	With 'sens' (as for run_sim()), it also returns a fourth value: the
+#	steady state's sensitivity to each parameter, indexed
+#	[metabolite, parameter].
+#	'stats' is as for run_sim(); a cache hit adds to its cache_hits.
+# enable_profiling (on=True)
+#	Start (or, with on=False, stop) recording, for each reaction, how many
+#	times it gets called and how much wall time it takes, plus how many
+#	derivative evaluations each solver run needs (see Profile for which
+#	those are). Returns the Profile that
+#	collects them; turning profiling on again starts a new one. It stays
+#	on across clear_sim(), so one profile can cover a script that
+#	rebuilds its network for each run. When off, it costs one test per
+#	derivative evaluation.
+# profile_report ()
+#	The profile so far, as a table keyed by reaction name (slowest first).
+#	Vectorized reactions all run together, so they share one row.
+# enable_steady_cache (max_entries=1024, disk_dir=None,
+#		       max_disk_bytes=256*1024*1024)
+#	Memoize steady_state_sim() for every network in this process. The key
+#	is a hash of the network (metabolites, initial values, reaction
+#	functions, connections and parameters) and of steady_state_sim()'s
+#	arguments. The 'max_entries' most recently used results stay in memory;
+#	with a 'disk_dir', they are also kept there (and reused by later runs)
+#	up to 'max_disk_bytes', evicting the least recently used first.
+#	Returns the cache (a sim_cache.SteadyStateCache).
+#	Note that a reaction function is identified by its name, so editing a
+#	gate's code without renaming it calls for a fresh disk_dir. A network
+#	with any reaction function that has no such name (a closure, a lambda
+#	or a nested function, which may capture different values under the
+#	same name) never uses the cache.
+# disable_steady_cache ()
+#	Turn the memoization off again.
+# steady_cache_stats ()
+#	A dict of the cache's hits (memory), disk_hits, misses, entries (in
+#	memory) and hit_rate; or None if it is off.
 # final_val (y, metabolite):
-#	Given the integration results from run_sim(), return the final value of
-#	a given metabolite (given by its name).
+#	Given the integration results from run_sim() (or a stored run from
+#	load_results()), return the final value of a given metabolite (given
+#	by its name).
+#
+# Each of these functions works on one default network, g_default. To build
+# several networks side by side (e.g., one per thread), make a Network()
+# for each; it has all of the same functions as methods, minus the "_sim".
+# E.g., net.add_metab(), net.run_sim(), net.steady_state_sim(),
+# net.clear() and net.compile().
 ########################################
 
-# The global variables:
-#	g_metabs:		list of metabolite-name strings.
-g_metabs = []
+import numpy as np
+import threading
+import itertools
 
-#	g_metab_initVal:	list of metabolite initial values.
-g_metab_initVal = []
+# Whichever reaction (if any) is currently executing in this thread; it's in
+# g_current.reaction. Kept per thread so that networks in different threads
+# can each find their own reaction.
+g_current = threading.local()
+g_current.reaction = None
 
-#	g_reactions:		list of reactions. Each is an object
-#		.reac=function, .name=string, .inputs=list[int],
-#		.outputs=list[int], .params=list[double].
-g_reactions = []
-
-# Whichever reaction function (if any) is currently executing.
-g_current_reaction=None
+# The sim_cache.SteadyStateCache that every network's steady_state_sim()
+# consults, or None; see enable_steady_cache().
+g_steady_cache = None
 
 # One object per reaction instance.
 class Reaction:
-    func=0	# The function that handles this reaction
+    gate=0	# The reaction function given to add_reaction()
+    func=0	# The function that handles this reaction: the gate, or what
+        	# the gate's prepare hook returned for it
     name=""	# Name of this reaction
     inputs=[]	# All reactants
     outputs=[]	# All products
@@ -73,96 +240,866 @@ class Reaction:
         	# needs parameters (e.g., reaction velocities)
     memory=None	# a slot that the user can use if desired
     def __init__ (self, F, N, I, O, P):
+        self.gate=F
         self.func=F; self.name=N; self.inputs=I; self.outputs=O; self.params=P
 
+# One reaction network, and everything needed to simulate it. Networks share
+# nothing, so different threads can each build and run their own.
+# Its members:
+#	metabs:		list of metabolite-name strings.
+#	metab_index:	dict mapping each metabolite name to its index.
+#	metab_initVal:	list of metabolite initial values.
+#	reactions:	list of Reaction objects. Each is an object
+#		.gate=function, .func=prepared function,
+#		.name=string, .inputs=list[int],
+#		.outputs=list[int], .params=list[double], .memory.
+#	compiled:	the CompiledNetwork built by compile(), or None if the
+#		network changed since the last compile.
+#	steady_path:	how the last steady_state_sim() found its answer.
+#	profile:	the Profile that enable_profiling() turned on, or None.
+#		It's a setting rather than part of the network, so clear()
+#		leaves it on.
+#	cache_dir:	where compile() caches compiled networks, or None.
+#		Like profile, it's a setting, and survives clear().
+class Network:
+    def __init__ (self):
+        self.profile=None; self.cache_dir=None
+        self.clear()
+
+    def clear (self):
+        self.metabs=[]; self.metab_index={}; self.reactions=[]
+        self.metab_initVal=[]
+        self.compiled=None; self.steady_path=None
+
+    # All metabolites must be declared here before using them in
+    # add_reaction().
+    def add_metab (self, r, init):
+        if (not (type(r) is str)):
+          raise Exception('Metabolite '+r+' given to add_metab() must be a string')
+
+        self.metab_index.setdefault (r, len(self.metabs))
+        self.metabs.append (r)
+        self.metab_initVal.append (init)
+        self.compiled=None
+
+    # def add_reaction()
+    #    Declare a new reaction. The inputs are:
+    #	reac: pointer to the reaction def.
+    #	reaction name: a string, just for debugging.
+    #	inputs: vector of names for the reactants.
+    #	outputs: vector of names for the products (there can be more than one).
+    #	parameters: vector of double for the instance parameters.
+    def add_reaction (self, reacFunc, name, inputs, outputs, params):
+        if (not (type(inputs) is list)):
+            raise Exception ('Inputs to reaction '+name+' must be a list')
+        if (not (type(outputs) is list)):
+            raise Exception ('Outputs to reaction '+name+' must be a list')
+        if (not (type(params) is list)):
+            raise Exception ('Params to reaction '+name+' must be a list')
+
+        # convert reactant names to indices into self.metabs[].
+        reac_idxs=[]
+        for reac in inputs:
+            reac_idxs.append (self.metab_number (reac));
+
+        prod_idxs=[]
+        for prod in outputs:
+            prod_idxs.append (self.metab_number (prod));
+
+        r = Reaction (reacFunc, name, reac_idxs, prod_idxs, params)
+        # Let the gate check the reaction and precompute what it can, once,
+        # rather than on every call (see "Prepared gates" in sim_library).
+        prepare = getattr (reacFunc, 'prepare', None)
+        if (prepare is not None):
+            r.func = prepare (reac_idxs, prod_idxs, params)
+        self.reactions.append (r)
+        self.compiled=None
+
+    # Save the network (metabolites, initial values and reactions) to 'path',
+    # as JSON if it ends in '.json' and otherwise as a numpy .npz file; see
+    # NETWORK_FORMAT. Every reaction function must be a module-level function
+    # (as the sim_library gates are), since the file names it by its module
+    # and name. The .npz format stores every parameter as a float.
+    def save_network (self, path):
+        gates = {}
+        for r in self.reactions:
+            gates.setdefault (gate_name (r), len(gates))
+        gateIdx = [gates[gate_name (r)] for r in self.reactions]
+        if (path.endswith ('.json')):
+            import json
+            net = {'format':NETWORK_FORMAT, 'gates':list(gates),
+                   'metabs':self.metabs,
+                   'init':[float(v) for v in self.metab_initVal],
+                   'reactions':[[g, r.name, [self.metabs[m] for m in r.inputs],
+                                 [self.metabs[m] for m in r.outputs],
+                                 [v if (type(v) is int) else float(v)
+                                  for v in r.params]]
+                                for g,r in zip (gateIdx, self.reactions)]}
+            with open (path, 'w') as f:
+                json.dump (net, f, separators=(',', ':'))
+            return
+        # Each reaction's inputs, outputs and params, concatenated, with
+        # pointers to where each reaction's share starts (as in a CSR matrix).
+        lists = {}
+        for field in ('inputs', 'outputs', 'params'):
+            rows = [getattr (r, field) for r in self.reactions]
+            lists[field+'_ptr'] = np.cumsum ([0] + [len(x) for x in rows])
+            lists[field] = np.array ([v for x in rows for v in x],
+                            dtype=(float if (field=='params') else np.intp))
+        with open (path, 'wb') as f:
+            np.savez_compressed (f, format=NETWORK_FORMAT,
+                    gates=np.array (list(gates)),
+                    metabs=np.array (self.metabs, dtype=str),
+                    init=np.array (self.metab_initVal, dtype=float),
+                    gate=np.array (gateIdx, dtype=np.intp),
+                    names=np.array ([r.name for r in self.reactions],
+                                    dtype=str), **lists)
+
+    # Replace the network with the one that save_network() saved in 'path'.
+    # This skips add_metab() and add_reaction(): names get resolved through
+    # one dict, the .npz format needs no resolving at all, and the only
+    # per-reaction work left is each gate's prepare hook (which still checks
+    # every reaction).
+    # find_gate() imports the module of each gate the file names, so a file
+    # can make us run any module on the path.
+    def load_network (self, path):
+        if (path.endswith ('.json')):
+            import json
+            with open (path) as f:
+                net = json.load (f)
+            check_format (net.get ('format'), path)
+            metabs = net['metabs']; init = net['init']
+            index = first_index (metabs)
+            def find (name):
+                try:
+                    return (index[name])
+                except KeyError:
+                    raise LookupError ('** There is no metabolite named '
+                                       + str(name) + '**')
+            gates = [find_gate (g) for g in net['gates']]
+            for rxn in net['reactions']:
+                check_gate_index (rxn[0], len(gates), path)
+            reactions = [(gates[g], name, [find(m) for m in ins],
+                          [find(m) for m in outs], params)
+                         for g,name,ins,outs,params in net['reactions']]
+        else:
+            with np.load (path) as f:
+                check_format (str (f['format']), path)
+                metabs = f['metabs'].tolist(); init = f['init'].tolist()
+                index = first_index (metabs)
+                for field in ('inputs', 'outputs'):
+                    if (np.any ((f[field] < 0) | (f[field] >= len(metabs)))):
+                        raise ValueError ('load_network: '+path+' has a '
+                                          +'metabolite index out of range')
+                gates = [find_gate (g) for g in f['gates'].tolist()]
+                for g in f['gate'].tolist():
+                    check_gate_index (g, len(gates), path)
+                split = {}
+                for field in ('inputs', 'outputs', 'params'):
+                    vals = f[field].tolist(); ptr = f[field+'_ptr'].tolist()
+                    split[field] = [vals[ptr[i]:ptr[i+1]]
+                                    for i in range(len(ptr)-1)]
+                reactions = list (zip ([gates[g] for g in f['gate'].tolist()],
+                                       f['names'].tolist(), split['inputs'],
+                                       split['outputs'], split['params']))
+
+        # Prepare every reaction before touching the network, so that a bad
+        # file leaves it as it was.
+        prepared = []
+        for gate,name,ins,outs,params in reactions:
+            r = Reaction (gate, name, ins, outs, params)
+            prepare = getattr (gate, 'prepare', None)
+            if (prepare is not None):
+                r.func = prepare (ins, outs, params)
+            prepared.append (r)
+        self.clear()
+        self.metabs = list (metabs)
+        self.metab_initVal = list (init)
+        self.metab_index = index
+        self.reactions = prepared
+
+    # Given the name of a metabolite, find its index in self.metabs.
+    def metab_number (self, name):
+        try:
+            return (self.metab_index [name])
+        except:
+            raise LookupError ('** There is no metabolite named ' + name +'**')
+
+    # Build self.compiled from the current network.
+    # With a 'cache_dir' (which sticks, for later compiles), reuse the
+    # compiled arrays from there if this topology was compiled before.
+    def compile (self, vectorize=True, cache_dir=None):
+        if (cache_dir is not None):
+            self.cache_dir = cache_dir
+        self.compiled = CompiledNetwork (self.metabs, self.reactions, vectorize,
+                                         self.cache_dir)
+        return (self.compiled)
+
+    # Called before each simulation: compile if the network changed, and pick
+    # up any parameter changes either way.
+    def prepare (self):
+        if (self.compiled is None):
+            self.compile()
+        else:
+            self.compiled.refresh_params()
+        self.compiled.profile = self.profile
+        return (self.compiled)
+
+    # Start (on=True) or stop (on=False) gathering a Profile of where the
+    # simulations spend their time. Turning it on again starts a new one.
+    def enable_profiling (self, on=True):
+        self.profile = Profile() if on else None
+        if (self.compiled is not None):
+            self.compiled.profile = self.profile
+        return (self.profile)
+
+    # The profile gathered since enable_profiling(), as a printable table.
+    def profile_report (self):
+        if (self.profile is None):
+            return ('Profiling is off; call enable_profiling() first.')
+        return (self.profile.report())
+
+    # Run a simulation from t=0 to t=tend.
+    # Return a 1D array of timepoints and a 2D array of results
+    # 'method' picks the integrator. 'LSODA' is scipy's odeint; 'BDF' and
+    # 'Radau' are implicit solvers from scipy.integrate.solve_ivp that suit
+    # stiff networks, and use the sparse analytic Jacobian. 'auto' (the
+    # default) picks one by the network's size; see pick_method(). 'rtol'
+    # and 'atol' override the solver's error tolerances.
+    # 'sens' asks for forward sensitivities too: it's a list of
+    # (reactionName, paramIndex) pairs, and we integrate
+    #	d/dt (dy/dp) = J * dy/dp + d(yprime)/dp
+    # for each of those parameters p alongside the state. Then we return a
+    # third value, a 3D array indexed [timepoint, metabolite, parameter].
+    # 'store' is a directory name: rather than building the results in
+    # memory, write them there (see ResultStore) 'chunk' timepoints at a
+    # time, and return memory-mapped arrays.
+    # 'events' is a list of Events. The solver locates each one as it
+    # happens, by root finding on its event function, and a terminal event
+    # ends the simulation there: the results then stop at the last timepoint
+    # before it, plus one last row for the event itself. We return an extra
+    # value (after the sensitivities, if any): for each event, an array of
+    # the times it happened.
+    # 'stats' is a SolverStats to add the solver's statistics to.
+    def run_sim (self, tend, n_timepoints=10, method='auto',
+                 rtol=None, atol=None, sens=None, store=None, chunk=10000,
+                 events=None, stats=None):
+        import numpy
+
+        if (self.profile is not None):
+            self.profile.begin_run()
+        if (store is not None):
+            if (sens is not None):
+                raise ValueError ('run_sim: cannot store sensitivities')
+            if (events is not None):
+                raise ValueError ('run_sim: cannot store a run with events')
+            res = ResultStore.create (store, self.metabs,
+                                      numpy.linspace (0, tend, n_timepoints))
+            row = 0
+            for t,y in self.run_sim_chunks (tend, n_timepoints, method,
+                                            rtol, atol, chunk, stats):
+                res.y[row:row+len(t)] = y
+                row += len(t)
+            res.y.flush()
+            res = ResultStore (store)
+            if (self.profile is not None):
+                self.profile.end_run()
+            return (res.t, res.y)
+
+        # array with n_points points evenly space between 0 and tend.
+        timePts = numpy.linspace (0, tend, n_timepoints)
+        net = self.prepare()
+        method = self.pick_method (method)
+        if (sens is not None):
+            net = SensitivitySystem (net, self.find_params (sens))
+        y0 = net.initial_state (self.metab_initVal)
+        breaks = self.breakpoints()
+        if (events is None):
+            y = integrate (net, y0, timePts, method, rtol, atol, breaks,
+                           stats)
+        else:
+            funcs = [e.function (net, self.metab_number (e.metab))
+                     for e in events]
+            timePts, y, tEvents = integrate_events (net, y0, timePts, method,
+                                                    rtol, atol, funcs, breaks,
+                                                    stats)
+
+        #print ('t=', timePts)
+        #print ('y=', y)
+        if (self.profile is not None):
+            self.profile.end_run()
+        res = (timePts, y) if (sens is None) else ((timePts,) + net.split (y))
+        return (res if (events is None) else res + (tEvents,))
+
+    # The times at which some reaction's drive has a corner (from the gates'
+    # .breakpoints hooks; see sim_library), sorted. Every simulation
+    # (run_sim(), steady_state_sim(), run_ensemble() and the transfer curves)
+    # restarts its solver at each of them.
+    def breakpoints (self):
+        times = set()
+        for r in self.reactions:
+            hook = getattr (r.gate, 'breakpoints', None)
+            if (hook is not None):
+                times.update (float(b) for b in hook (r.params))
+        return (sorted (times))
+
+    # Run the simulation of run_sim() on a quasi-steady-state reduction of
+    # the network; see sim_reduce.run_sim_reduced().
+    def run_sim_reduced (self, tend, n_timepoints=10, method='auto',
+                         gap=100, compare=True):
+        import sim_reduce
+        return (sim_reduce.run_sim_reduced (tend, n_timepoints, method, gap,
+                                            compare, self))
+
+    # The integrator that method='auto' stands for: LSODA for a small
+    # network, where a dense Jacobian is cheap, and BDF above SPARSE_METABS
+    # metabolites, where only the sparse one keeps the cost of each step
+    # linear in the size of the network. Any other method is left alone.
+    def pick_method (self, method):
+        if (method != 'auto'):
+            return (method)
+        return ('LSODA' if (len(self.metabs) <= SPARSE_METABS) else 'BDF')
+
+    # Like run_sim(), but a generator: it yields (timepoints, results) for
+    # 'chunk' timepoints at a time. Each chunk's integration starts from
+    # where the previous one stopped, so only one chunk is ever in memory.
+    def run_sim_chunks (self, tend, n_timepoints=10, method='auto',
+                        rtol=None, atol=None, chunk=10000, stats=None):
+        timePts = np.linspace (0, tend, n_timepoints)
+        net = self.prepare()
+        method = self.pick_method (method)
+        breaks = self.breakpoints()
+        y0 = np.asarray (self.metab_initVal, dtype=float)
+        for start in range (0, n_timepoints, chunk):
+            if (start == 0):
+                y = integrate (net, y0, timePts[:chunk], method, rtol, atol,
+                               breaks, stats)
+                y0 = y[-1]
+                yield (timePts[:chunk], y)
+                continue
+            # Restart from the last point of the previous chunk.
+            t = timePts[start-1:start+chunk]
+            y = integrate (net, y0, t, method, rtol, atol, breaks, stats)[1:]
+            y0 = y[-1]
+            yield (t[1:], y)
+
+    # Turn a list of (reactionName, paramIndex) pairs into a list of
+    # (Reaction, paramIndex) pairs.
+    def find_params (self, sens):
+        params = []
+        for name,idx in sens:
+            r = self.find_reaction (name)
+            if (idx >= len(r.params)):
+                raise LookupError ('** Reaction '+name+' has no parameter '
+                                   +str(idx)+'**')
+            params.append ((r, idx))
+        return (params)
+
+    # The (first) reaction called 'name'.
+    def find_reaction (self, name):
+        matches = [r for r in self.reactions if r.name == name]
+        if (len(matches) == 0):
+            raise LookupError ('** There is no reaction named '+name+'**')
+        return (matches[0])
+
+    # Run many replicas of the network at once, each with its own initial
+    # values and/or reaction parameters, as one stacked system (see
+    # integrate_ensemble()). 'initVals' is a 2D array [replica, metabolite]
+    # (by default, every replica starts from the network's own initial
+    # values). 'params' is a dict from reaction name to a 2D array
+    # [replica, parameter] of that reaction's params[] in each replica; the
+    # reactions it leaves out keep their own. Each row of the results then
+    # belongs to one replica.
+    # With 'processes' > 1, the replicas are split evenly between that many
+    # worker processes, each of which integrates its share as one system.
+    # Returns the timepoints and a 3D array [replica, timepoint, metabolite].
+    def run_ensemble (self, tend, n_timepoints=10, initVals=None, params=None,
+                      processes=1):
+        timePts = np.linspace (0, tend, n_timepoints)
+        net = self.prepare()
+        params = {} if (params is None) else params
+        sizes = [len(P) for P in params.values()]
+        if (initVals is not None):
+            sizes.append (len(initVals))
+        if ((len(sizes) == 0) or (min(sizes) != max(sizes))):
+            raise ValueError ('run_ensemble: initVals and each params array '
+                              + 'need one row per replica')
+        n_rep = sizes[0]
+        if (initVals is None):
+            Y0 = np.tile (np.array (self.metab_initVal, dtype=float), (n_rep,1))
+        else:
+            Y0 = np.array (initVals, dtype=float)
+            if (Y0.shape != (n_rep, len(self.metabs))):
+                raise ValueError ('run_ensemble: initVals needs one column per '
+                                  + 'metabolite')
+        kF, kR, slow = self.ensemble_params (net, params, n_rep)
+
+        if (self.profile is not None):
+            self.profile.begin_run()
+        Y = run_ensemble_slices (net, Y0, timePts, kF, kR, slow, processes,
+                                 self.breakpoints())
+        if (self.profile is not None):
+            self.profile.end_run()
+        return (timePts, Y)
+
+    # Turn run_ensemble()'s 'params' into per-replica rate constants kF and
+    # kR for the vectorized reactions of the compiled network 'net', and a
+    # dict {Reaction: 2D array [replica, parameter]} (or None) for the rest.
+    def ensemble_params (self, net, params, n_rep):
+        kF = np.tile (net.kF, (n_rep,1))
+        kR = np.tile (net.kR, (n_rep,1))
+        slow = {}
+        for name,P in params.items():
+            r = self.find_reaction (name)
+            P = np.asarray (P, dtype=float)
+            if ((P.ndim != 2) or (P.shape[1] != len(r.params))):
+                raise ValueError ('run_ensemble: the params for '+name
+                                  +' need one column per parameter')
+            if (r in net.fast):
+                j = net.fast.index (r)
+                for p in range(n_rep):
+                    kF[p,j], kR[p,j], _ = mass_action_form (r, list (P[p]))
+            else:
+                slow[r] = P
+        return (kF, kR, (slow if slow else None))
+
+    # The function that gets passed to scipy.integrate.odeint(), and gives it
+    # all of the derivatives at time t.
+    # Inputs:  'y' is a column vector of the variables at time 't'.
+    # Outputs: 'yprime', a column vector of the first derivatives.
+    def reactions_func (self, y, t):
+        if (self.compiled is None):
+            self.compile()
+        return (self.compiled.rhs (y, t))
+
+    # The Jacobian d(yprime)/d(y) of reactions_func() at (y,t), as a
+    # scipy.sparse matrix. Its sparsity pattern is self.compiled.sparsity.
+    def jacobian (self, y, t):
+        return (self.prepare().jacobian (y, t))
+
+    # Compute a transfer curve.
+    # Inputs:
+    #	inName, Cmax, outName: sweep the main input inName from 0 to Cmax
+    #		and measure the response at outName.
+    #	sideInputNames, sideInputVals: lists of the names of side inputs and
+    #		the concentrations to hold them steady at.
+    #	nPoints: the number of evenly-spaced points to evaluate inName at.
+    # Outputs: vectors on x & y values for the transfer curve; each is
+    #	n_points x 1.
+    # Operation:
+    #	The function creates constant sources to drive the inputs, and then
+    #	runs all of the sample points at once as an ensemble: one replica of
+    #	the network per point, each with its own value for the main input's
+    #	driver. The drivers are not added to the network itself.
+    #	With 'stats' (a SolverStats), the solver calls add to it, and its
+    #	settle_times get the horizon by which each point settled.
+    def run_xfer_curve (self, inName, Cmax,outName,
+                        sideInputNames,sideInputVals,nPoints,stats=None):
+        # Run the sims until this max time.For now, just use a constant.
+        tMax = 100
+
+        net, main = self.xfer_network (inName, sideInputNames, sideInputVals)
+        out_numb = self.metab_number (outName)
+        xVal = np.linspace (0, Cmax, nPoints)	# input values
+        kF = np.tile (net.kF, (nPoints,1))
+        kF[:, net.fast.index(main)] = xVal
+        Y0 = np.tile (np.array (self.metab_initVal, dtype=float), (nPoints,1))
+        if (self.profile is not None):
+            self.profile.begin_run()
+        tMax,Y,OK = ensemble_steady_state (net, Y0, tMax, kF, stats=stats,
+                                           breaks=self.breakpoints())
+        if (self.profile is not None):
+            self.profile.end_run()
+        assert (OK.all())
+
+        return (xVal.tolist(), Y[:,out_numb].tolist())
+
+    # The network plus constant drivers: one holding each side input at its
+    # value, and 'main' driving the main input (to 0, until its kF gets set).
+    # Returns a private CompiledNetwork (the drivers are not added to the
+    # network itself), and 'main'.
+    def xfer_network (self, inName, sideInputNames, sideInputVals):
+        import sim_library as sl
+
+        # Drive the side inputs with the desired constant values.
+        assert (len(sideInputNames) == len(sideInputVals))
+        drivers = []
+        for idx,name in enumerate(sideInputNames):
+            drivers.append (Reaction (sl.constDriver, name, [],
+                            [self.metab_number(name)], [sideInputVals[idx]]))
+
+        # Drive the main input with another constant; each replica gets its own.
+        main = Reaction (sl.constDriver, inName, [],
+                         [self.metab_number(inName)], [0])
+        net = CompiledNetwork (self.metabs, self.reactions + drivers + [main])
+        net.profile = self.profile
+        return (net, main)
+
+    # Compute a transfer curve by numerical continuation; see
+    # sim_continuation.run_xfer_continuation().
+    def run_xfer_continuation (self, inName, Cmax, outName,
+                               sideInputNames, sideInputVals, max_step=.1):
+        import sim_continuation
+        return (sim_continuation.run_xfer_continuation (inName, Cmax, outName,
+                        sideInputNames, sideInputVals, max_step, self))
+
+    # Run until all variables are pretty steady.
+    # However, some systems never reach any steady state, so detect that if
+    # needed
+    # Return a tuple (t, y, OK)
+    # mode='restart' re-simulates from t=0 with a doubled horizon each time.
+    # mode='continue' keeps the solver going from where it stopped, so each
+    # doubling only integrates the new interval; see steady_state_continue().
+    # mode='root' solves for the fixed point directly, and integrates only if
+    # that fails; see steady_state_root().
+    # self.steady_path records how the answer was found: the mode, except that
+    # mode='root' gives 'root' or 'integrate'.
+    # 'sens' is a list of (reactionName, paramIndex) pairs, as for run_sim().
+    # Then we also return the steady state's sensitivities: a 2D array
+    # indexed [metabolite, parameter]. At a stable steady state the
+    # sensitivity ODE settles where J * dy/dp = -d(yprime)/dp, so we solve
+    # that directly (with the conservation laws in place of the redundant
+    # rows of J, as in steady_state_root()).
+    # If enable_steady_cache() is on, an identical earlier problem (the same
+    # network, parameters, initial values and arguments) just returns its
+    # earlier answer. (Unless some reaction function is a closure or the
+    # like; see content_key().)
+    # 'stats' is a SolverStats that gets every solver call along the way.
+    def steady_state_sim (self, tEndGuess, method='auto', mode='restart',
+                          sens=None, stats=None):
+        cache = g_steady_cache
+        key = None if (cache is None) else self.content_key (
+                                            (tEndGuess, method, mode, sens))
+        if (key is None):
+            return (self.steady_state_solve (tEndGuess, method, mode, sens,
+                                             stats))
+        hit = cache.get (key)
+        if (hit is not None):
+            self.steady_path = hit[-1]
+            if (stats is not None):
+                stats.cache_hits += 1
+            return (hit[:-1])
+        result = self.steady_state_solve (tEndGuess, method, mode, sens,
+                                          stats)
+        cache.put (key, result + (self.steady_path,))
+        return (result)
+
+    # steady_state_sim(), without the cache.
+    def steady_state_solve (self, tEndGuess, method, mode, sens, stats=None):
+        if (sens is not None):
+            t,y,OK = self.steady_state_sim (tEndGuess, method, mode,
+                                            stats=stats)
+            return (t, y, OK, self.steady_state_sens (y[-1], sens))
+        self.steady_path = mode
+        if (mode == 'continue'):
+            return (self.steady_state_continue (tEndGuess, method, stats))
+        if (mode == 'root'):
+            t,y,OK,self.steady_path = self.steady_state_root (tEndGuess, method,
+                                                              stats)
+            return (t,y,OK)
+        if (mode != 'restart'):
+            raise ValueError ('steady_state_sim: unknown mode '+str(mode))
+
+        tEnd = tEndGuess/2
+        done = False
+        OK = True
+        while (not done):
+            if (tEnd > tEndGuess*1000):
+                print ('Simulation did not converge at t=', tEnd)
+                return (tEnd,y,False)
+
+            tEnd = tEnd*2	# Try a longer sim.
+            t,y = self.run_sim (tEnd, 100, method, stats=stats)
+
+            # Each metab must be tiny or have moved by <1% over the last 10%.
+            x1=y[90]; x2=y[99]
+            big = np.maximum (x1,x2)
+            with np.errstate (divide='ignore', invalid='ignore'):
+                done = np.all ((big<.001) | (np.abs(x2-x1)/big < .01))
+        return  (tEnd, y, True)
+
+    # d(yss)/dp at the steady state yss, for the parameters in 'sens'.
+    def steady_state_sens (self, yss, sens):
+        net = self.prepare()
+        L, pivots = net.conservation_laws()
+        J = net.jacobian_dense (yss, 0)
+        J[pivots] = L
+        dfdp = net.param_partials (yss, 0, self.find_params (sens))
+        dfdp[pivots] = 0
+        try:
+            return (-np.linalg.solve (J, dfdp))
+        except np.linalg.LinAlgError:
+            return (-np.linalg.lstsq (J, dfdp, rcond=None)[0])
+
+    # A hash of everything that a simulation's result depends on: the
+    # metabolites and their initial values, and each reaction's function,
+    # connections and parameters; plus anything in 'extra' (which must have
+    # a repeatable repr()).
+    # Functions are identified by name (see gate_path()). A closure, lambda
+    # or nested function has no unique name (two closures from one factory
+    # share one, whatever values they captured), so then there is no key,
+    # and we return None.
+    def content_key (self, extra=None):
+        import hashlib
+        h = hashlib.sha256()
+        h.update (repr ((self.metabs, [float(v) for v in self.metab_initVal],
+                         extra)).encode())
+        for r in self.reactions:
+            name = gate_path (r.gate)
+            if (name is None):
+                return (None)
+            h.update (repr ((name, r.inputs, r.outputs, r.params)).encode())
+        return (h.hexdigest())
+
+    # Is the network steady at state 'y', having run for time 'tEnd'?
+    # The same test that steady_state_sim() applies to its last 10% of samples,
+    # but using the derivatives directly: each metabolite must be tiny, or be
+    # moving slowly enough that it would change by <1% over another .1*tEnd.
+    def is_steady (self, y, tEnd):
+        net = self.prepare()
+        return (bool (steady_mask (y, net.rhs (y, tEnd), tEnd)))
+
+    # steady_state_sim(mode='continue').
+    # Builds one solver that runs from t=0 towards the same 1024*tEndGuess limit
+    # that the restarting version uses, and stops it at tEndGuess, 2*tEndGuess,
+    # 4*tEndGuess... to test is_steady(). Nothing is ever re-integrated.
+    # Returns (t, y, OK) like steady_state_sim(); y has 100 samples for each
+    # interval that we integrated, so y[-1] is the state at time t.
+    # As in run_sim(), the solver stops at each of the network's breakpoints
+    # and a fresh one carries on from there. Each solver goes into 'stats'
+    # (if given) as one call.
+    def steady_state_continue (self, tEndGuess, method='auto', stats=None):
+        net = self.prepare()
+        if (self.profile is not None):
+            self.profile.begin_run()
+        res = self.steady_state_steps (net, tEndGuess, method, stats)
+        if (self.profile is not None):
+            self.profile.end_run()
+        return (res)
+
+    # The body of steady_state_continue(), on the compiled network 'net'.
+    def steady_state_steps (self, net, tEndGuess, method, stats):
+        method = self.pick_method (method)
+        rtol, atol = default_tols (method)
+        # LSODA wants a dense Jacobian; BDF and Radau can use the sparse one.
+        jac = net.jacobian_dense if (method=='LSODA') else net.jacobian
+        # Where each solver must stop.
+        bounds = [b for b in self.breakpoints() if (0 < b < tEndGuess*1024)]
+        bounds.append (tEndGuess*1024)
+        def start (t0, y0):
+            return (solver_class(method) (lambda t,y: net.rhs (y,t), t0, y0,
+                        bounds.pop (0), rtol=rtol, atol=atol,
+                        jac=lambda t,y: jac(y,t)))
+        solver = start (0, np.array (self.metab_initVal, dtype=float))
+        tStart = 0
+
+        tPrev = 0; tEnd = tEndGuess
+        samples = [np.array (self.metab_initVal, dtype=float)]
+        steps = []	# the size of each step of the current solver
+        def record (message):
+            if (stats is not None):
+                stats.add (method, tStart, solver.t, solver.nfev, solver.njev,
+                           solver.nlu, len(steps), None, steps, message)
+        while (True):
+            # Sample this interval as we step through it.
+            tSample = np.linspace (tPrev, tEnd, 100)[1:]
+            i = 0
+            while (i < len(tSample)):
+                if ((solver.status == 'finished') and (len(bounds) != 0)):
+                    record ('breakpoint')	# restart at the corner
+                    tStart = solver.t; steps = []
+                    solver = start (solver.t, solver.y)
+                if (solver.status != 'running'):
+                    break
+                if (solver.t < tSample[i]):
+                    tBefore = solver.t
+                    if (solver.step() is not None):	# i.e., an error message
+                        break
+                    steps.append (solver.t - tBefore)
+                interp = solver.dense_output()
+                while ((i < len(tSample)) and (tSample[i] <= solver.t)):
+                    samples.append (interp (tSample[i])); i += 1
+            if (i < len(tSample)):
+                print ('Simulation failed at t=', solver.t)
+                record ('failed')
+                return (solver.t, np.array(samples), False)
+
+            if (steady_mask (samples[-1], net.rhs (samples[-1], tEnd), tEnd)):
+                record ('steady')
+                return (tEnd, np.array(samples), True)
+            if (tEnd*2 > tEndGuess*1024):
+                print ('Simulation did not converge at t=', tEnd)
+                record ('did not converge')
+                return (tEnd, np.array(samples), False)
+            tPrev = tEnd; tEnd = tEnd*2
+
+    # Find the steady state directly, by solving yprime(y)=0.
+    # Conservation laws make that system singular (e.g., a metabolite that never
+    # changes has an all-zero row), so we replace one redundant equation per law
+    # with the law itself: L @ y = L @ y0. The starting point comes from
+    # integrating to tEndGuess/10, and scipy's hybrid (trust-region) Newton
+    # solver takes it from there.
+    # If the Jacobian there is singular, the solver does not get to a root, the
+    # root is negative or it is unstable (so the network would oscillate or go
+    # elsewhere), we fall back to steady_state_continue().
+    # Returns (t, y, OK, path), where path is 'root' or 'integrate'. On the root
+    # path, t is tEndGuess and y is the seed integration with the steady state
+    # appended as its last row.
+    # 'stats' gets the seed integration, the root finding (as method 'hybr')
+    # and any fallback.
+    def steady_state_root (self, tEndGuess, method='auto', stats=None):
+        import scipy.optimize
+        net = self.prepare()
+        L, pivots = net.conservation_laws()
+
+        tSeed,ySeed = self.run_sim (tEndGuess/10, 10, method, stats=stats)
+        y0 = ySeed[-1]
+        target = L @ ySeed[0]
+        def G (y):
+            g = net.rhs (y, tEndGuess)
+            g[pivots] = L @ y - target
+            return (g)
+        def dG (y):
+            J = net.jacobian_dense (y, tEndGuess)
+            J[pivots] = L
+            return (J)
+
+        if (np.linalg.cond (dG (y0)) > 1e12):
+            path = 'integrate'
+        else:
+            if (self.profile is not None):
+                self.profile.begin_run()
+            sol = scipy.optimize.root (G, y0, jac=dG, method='hybr')
+            if (self.profile is not None):
+                self.profile.end_run()
+            if (stats is not None):
+                stats.add ('hybr', tEndGuess, tEndGuess, sol.nfev,
+                           sol.get ('njev', 0), message=sol.message)
+            yss = sol.x
+            scale = np.maximum (np.abs(yss), 1.0)
+            path = 'root'
+            # hybr often reports slow progress once it is already sitting on
+            # the root, so judge it by the residual rather than sol.success.
+            if (np.any (yss < -1e-6*scale) or np.any (np.abs(G(yss)) > 1e-6*scale)):
+                path = 'integrate'
+            elif (not is_stable (net.jacobian_dense (yss, tEndGuess), L)):
+                path = 'integrate'
+
+        if (path == 'integrate'):
+            return (self.steady_state_continue (tEndGuess, method, stats)
+                    + ('integrate',))
+        return (tEndGuess, np.vstack ((ySeed, yss)), True, 'root')
+
+    # Given the integration results from a simulation, return the final value of
+    # a given metabolite (given by its name).
+    def final_val (self, y, metab):
+        if (isinstance (y, ResultStore)):
+            return (y.final_val (metab))
+        return (y [-1, self.metab_number (metab)])
+
+########################################
+## The original interface: the same functions, acting on one default network.
+
+g_default = Network()
+
 def clear_sim():
-    global g_metabs, g_metab_initVal, g_reactions;
-    g_metabs=[]; g_reactions=[]; g_metab_initVal=[];
+    g_default.clear()
 
-# All metabolites must be declared here before using them in add_reaction().
 def add_metab (r, init):
-    if (not (type(r) is str)):
-      raise Exception('Metabolite '+r+' given to add_metab() must be a string')
-
-    global g_metabs, g_metab_initVal;
-    g_metabs.append (r)
-    g_metab_initVal.append (init)
+    g_default.add_metab (r, init)
 
-# def add_reaction()
-#    Declare a new reaction. The inputs are:
-#	reac: pointer to the reaction def.
-#	reaction name: a string, just for debugging.
-#	inputs: vector of names for the reactants.
-#	outputs: vector of names for the products (there can be more than one).
-#	parameters: vector of double for the instance parameters.
 def add_reaction (reacFunc, name, inputs, outputs, params):
-    global g_reactions, g_metabs;
+    g_default.add_reaction (reacFunc, name, inputs, outputs, params)
 
-    if (not (type(inputs) is list)):
-        raise Exception ('Inputs to reaction '+name+' must be a list')
-    if (not (type(outputs) is list)):
-        raise Exception ('Outputs to reaction '+name+' must be a list')
-    if (not (type(params) is list)):
-        raise Exception ('Params to reaction '+name+' must be a list')
+def metab_number (name):
+    return (g_default.metab_number (name))
 
-    # convert reactant names to indices into g_metabs[].
-    reac_idxs=[]
-    for reac in inputs:
-        reac_idxs.append (metab_number (reac));
+def compile_sim (vectorize=True, cache_dir=None):
+    return (g_default.compile (vectorize, cache_dir))
 
-    prod_idxs=[]
-    for prod in outputs:
-        prod_idxs.append (metab_number (prod));
+def run_sim (tend, n_timepoints=10, method='auto', rtol=None, atol=None,
+             sens=None, store=None, chunk=10000, events=None, stats=None):
+    return (g_default.run_sim (tend, n_timepoints, method, rtol, atol, sens,
+                               store, chunk, events, stats))
 
-    r = Reaction (reacFunc, name, reac_idxs, prod_idxs, params)
-    g_reactions.append (r)
+def enable_profiling (on=True):
+    return (g_default.enable_profiling (on))
 
-# Given the name of a metabolite, find its index in g_metabs.
-def metab_number (name):
-    global g_metabs
-    try:
-        return (g_metabs.index (name))
-    except:
-        raise LookupError ('** There is no metabolite named ' + name +'**')
+def profile_report():
+    return (g_default.profile_report())
+
+def enable_steady_cache (max_entries=1024, disk_dir=None,
+                         max_disk_bytes=256*1024*1024):
+    import sim_cache
+    global g_steady_cache
+    g_steady_cache = sim_cache.SteadyStateCache (max_entries, disk_dir,
+                                                 max_disk_bytes)
+    return (g_steady_cache)
+
+def disable_steady_cache():
+    global g_steady_cache
+    g_steady_cache = None
+
+def steady_cache_stats():
+    return (None if (g_steady_cache is None) else g_steady_cache.stats())
+
+def save_network (path):
+    g_default.save_network (path)
+
+def load_network (path):
+    g_default.load_network (path)
+
+def run_sim_reduced (tend, n_timepoints=10, method='auto', gap=100,
+                     compare=True):
+    return (g_default.run_sim_reduced (tend, n_timepoints, method, gap,
+                                       compare))
+
+def run_ensemble (tend, n_timepoints=10, initVals=None, params=None,
+                  processes=1):
+    return (g_default.run_ensemble (tend, n_timepoints, initVals, params,
+                                    processes))
+
+def run_sim_chunks (tend, n_timepoints=10, method='auto', rtol=None,
+                    atol=None, chunk=10000, stats=None):
+    return (g_default.run_sim_chunks (tend, n_timepoints, method, rtol, atol,
+                                      chunk, stats))
 
-# Run a simulation from t=0 to t=tend.
-# Return a 1D array of timepoints and a 2D array of results
-def run_sim (tend, n_timepoints=10):
-    import numpy
-    import scipy.integrate
-    global g_metabs, g_metab_initVal
-
-    # array with n_points points evenly space between 0 and tend.
-    timePts = numpy.linspace (0, tend, n_timepoints)
-
-    # odeint inputs:
-    #   - function that we supply, which must return state-variable derivatives
-    #   - initial values of state variables (and the size of this 1D array tells
-    #     odeint how many state variables there are).
-    #   - an array of the times when we want the DFQ solved.
-    # odeint outputs: just one, a 2D array with
-    #   - one row per requested timepoint 
-    #   - one column per metabolite
-    y = scipy.integrate.odeint (reactions_func, g_metab_initVal, timePts)
-
-    #print ('t=', timePts)
-    #print ('y=', y)
-    return (timePts, y)
-
-# The function that gets passed to scipy.integrate.odeint(), and gives it all
-# of the derivatives at time t.
-# Inputs:  'y' is a column vector of the variables at time 't'.
-# Outputs: 'yprime', a column vector of the first derivatives.
 def reactions_func (y, t):
-    # Zero the vector of rates, so that each reaction can accumulate its output
-    # rates into the vector.
-    global g_reactions, g_metabs, g_current_reaction
+    return (g_default.reactions_func (y, t))
+
+def jacobian (y, t):
+    return (g_default.jacobian (y, t))
+
+def run_xfer_continuation (inName, Cmax, outName, sideInputNames,
+                           sideInputVals, max_step=.1):
+    return (g_default.run_xfer_continuation (inName, Cmax, outName,
+                            sideInputNames, sideInputVals, max_step))
+
+def run_xfer_curve (inName, Cmax,outName, sideInputNames,sideInputVals,nPoints,
+                    stats=None):
+    return (g_default.run_xfer_curve (inName, Cmax, outName, sideInputNames,
+                                      sideInputVals, nPoints, stats))
+
+def steady_state_sim (tEndGuess, method='auto', mode='restart', sens=None,
+                      stats=None):
+    return (g_default.steady_state_sim (tEndGuess, method, mode, sens, stats))
+
+def is_steady (y, tEnd):
+    return (g_default.is_steady (y, tEnd))
+
+def final_val (y, metab):
+    return (g_default.final_val (y, metab))
+
+# The original, one-reaction-at-a-time evaluation. The compiled network uses
+# it for every reaction that it could not vectorize.
+# Accumulates each reaction's slews into 'yprime' and returns it.
+# 'params', if given, replaces the reaction's own params[] (so it only makes
+# sense with just one reaction).
+def reactions_loop (y, t, reactions, yprime, params=None):
     import numpy
-    assert (y.size == len(g_metabs))
-    yprime = numpy.zeros (y.size)
 
-    for r in g_reactions:
-        g_current_reaction = r	# for write_my_space() below.
+    for r in reactions:
+        g_current.reaction = r	# for write_my_space() below.
 
         # Prepare inputs[]; the current values of this reaction's reactants.
         inputs = numpy.zeros (len(r.inputs))
@@ -178,7 +1115,8 @@ def reactions_func (y, t):
  	# i.e., how fast it slews each of its products. In fact, it returns one
         # list for inputs and one for outputs, since chemical reactions consume
         # their inputs as well as produce outputs.
-        in_slews,out_slews = r.func (t, inputs, outputs, r.params)
+        in_slews,out_slews = r.func (t, inputs, outputs,
+                                     r.params if (params is None) else params)
 
         # Sum its d(product)/dt into the total metabolite d/dt.
         assert (len(out_slews) == len(r.outputs))
@@ -186,7 +1124,7 @@ def reactions_func (y, t):
             yprime[met_idx] += out_slews[idx]
 
         # Ditto for the input slew rates.
-        if (in_slews != []):
+        if (len(in_slews) != 0):
             assert (len(in_slews) == len(r.inputs))
             for idx,met_idx in enumerate(r.inputs):
                 yprime[met_idx] += in_slews[idx]
@@ -194,119 +1132,1199 @@ def reactions_func (y, t):
         if (False):
             print ('t=',t, 'reaction', r.name, ': input concs ', end='')
             for idx, met_idx in enumerate(r.inputs):
-                print (g_metabs[met_idx], '=', y[idx], end='')
+                print (met_idx, '=', y[idx], end='')
 
             print ('; output slews ')
             for idx, met_idx in enumerate(range(r.outputs)):
-                print (g_metabs[met_idx], '=', y[idx], end='')
+                print (met_idx, '=', y[idx], end='')
             print ('')
 
     return (yprime)
 
-# Compute a transfer curve.
-# Inputs:
-#	inName, Cmax, outName: sweep the main input inName from 0 to Cmax
-#		and measure the response at outName.
-#	sideInputNames, sideInputVals: lists of the names of side inputs and
-#		the concentrations to hold them steady at.
-#	nPoints: the number of evenly-spaced points to evaluate inName at.
-# Outputs: vectors on x & y values for the transfer curve; each is n_points x 1.
-# Operation:
-#	At each sample point, the function creates constant sources to drive
-#	the inputs and then runs a simulation 
-def run_xfer_curve (inName, Cmax,outName, sideInputNames,sideInputVals,nPoints):
-    import sim_infrastructure as si
+########################################
+## The compiled network.
+## Every reaction whose function is one of the mass-action gates in
+## sim_library has a net rate
+##	v = kF*prod(inputs) - kR*prod(outputs)
+## and simply adds v (times a stoichiometric coefficient) to each metabolite it
+## touches. So all of them can be evaluated with one gather of y, one batched
+## rate evaluation and one scatter of the rates through the stoichiometry
+## matrix. Anything else goes through reactions_loop().
+
+# If reaction 'r' can be vectorized, return (kF, kR, consumes_inputs).
+# Otherwise return None. 'params' (by default, r.params) are the reaction's
+# parameters.
+def mass_action_form (r, params=None):
     import sim_library as sl
-    import numpy as np
-    global g_reactions;
-
-    # Run the sims until this max time.For now, just use a constant.
-    tMax = 100
-
-    # Drive the side inputs with the desired constant values.
-    assert (len(sideInputNames) == len(sideInputVals))
-    for idx,name in enumerate(sideInputNames):
-        si.add_reaction (sl.constDriver,name, [],[name], [sideInputVals[idx]])
-
-    # Drive the main input with another constant (we will keep changing its
-    # actual value on the fly).
-    si.add_reaction (sl.constDriver,inName, [], [inName], [0]);
-
-    # Now do the xfer curve points, one sim at a time
-    out_numb = metab_number (outName)
-    xVal = np.linspace (0, Cmax, nPoints).tolist()	# input values
-    yVal = []		# will get filled with output values
-    for x in xVal:
-        # The final reaction added was our main input. Drive its value now.
-        g_reactions[-1].params[0] = x
-        tMax,y,OK = steady_state_sim (tMax)
-        assert (OK)
-        yVal.append (y[-1,out_numb])	# i.e., the desired output's final value
-
-    return (xVal,yVal)
-
-# Run until all variables are pretty steady.
-# However, some systems never reach any steady state, so detect that if needed
-# Return a tuple (t, y, OK)
-def steady_state_sim (tEndGuess):
-    tEnd = tEndGuess/2
-    done = False
-    OK = True
-    while (not done):
-        if (tEnd > tEndGuess*1000):
-            print ('Simulation did not converge at t=', tEnd)
-            return (t,y,False)
-
-        tEnd = tEnd*2	# Try a longer sim.
-        t,y = run_sim (tEnd, 100)
-
-        done = True
-        n_react = (y.shape) [1]
-        for i in range (n_react):	# For each column... i.e., each metab
-            x1=y[90,i]; x2=y[99,i]
-            done = done and ((max(x1,x2)<.001) or (abs(x2-x1)/max(x2,x1) < .01))
-    return  (tEnd, y, True)
-
-# Given the integration results from a simulation, return the final value of
-# a given metabolite (given by its name).
-def final_val (y, metab):
-    return (y [-1, metab_number (metab)])
+    params = r.params if (params is None) else params
+    if ((r.gate is sl.mass_action) or (r.gate is sl.mass_action_held)):
+        sl.checkInputs (r.name, len(r.inputs),len(r.outputs),2,
+                        r.inputs, r.outputs, params)
+        return (params[0], params[1], r.gate is sl.mass_action)
+    if (r.gate is sl.constDriver):
+        # out' = desired - out is just kF=desired, kR=1 with no inputs.
+        sl.checkInputs (r.name, 0,1,1, r.inputs, r.outputs, params)
+        return (params[0], 1, False)
+    return (None)
+
+class CompiledNetwork:
+    profile=None	# the owning Network's Profile, if it is profiling
+
+    def __init__ (self, metabs, reactions, vectorize=True, cache_dir=None):
+        self.n_metabs = len(metabs)
+        self.fast = []	# the vectorized reactions
+        self.slow = []	# the ones that reactions_loop() must handle
+        consumes = []
+        for r in reactions:
+            form = mass_action_form (r) if vectorize else None
+            if (form is None):
+                self.slow.append (r)
+            else:
+                self.fast.append (r)
+                consumes.append (form[2])
+
+        # Everything but the rate constants depends only on the topology, so
+        # it can come from the cache.
+        path = None
+        if (cache_dir is not None):
+            import os
+            path = os.path.join (cache_dir,
+                                 'net-'+self.topology_key (consumes)+'.npz')
+        if ((path is None) or not self.load (path)):
+            self.build (consumes)
+            if (path is not None):
+                self.save (path)
+
+        self.kF = np.zeros (len(self.fast))
+        self.kR = np.zeros (len(self.fast))
+        self.refresh_params()
+
+    # The arrays that describe the network's structure, which the cache saves.
+    # (The stoichiometry matrix is rebuilt from rows, cols and coefs.)
+    cached_arrays = ['in_idx', 'out_idx', 'rows', 'cols', 'coefs',
+                     'jac_rows', 'jac_cols', 'jac_coefs', 'jac_slots']
+
+    # A hash of everything that build() depends on: which reactions are
+    # vectorized, whether they consume their inputs, and what every reaction
+    # is connected to.
+    def topology_key (self, consumes):
+        import hashlib
+        h = hashlib.sha256 (b'CompiledNetwork v1')
+        h.update (repr ((self.n_metabs, consumes,
+                         [(r.inputs, r.outputs) for r in self.fast],
+                         [(r.inputs, r.outputs) for r in self.slow])).encode())
+        return (h.hexdigest())
+
+    # Fill in the cached arrays from the file 'path'. Returns False if there
+    # is no such file (or it is unreadable), in which case we must build().
+    def load (self, path):
+        import scipy.sparse
+        try:
+            with np.load (path) as f:
+                for name in self.cached_arrays:
+                    setattr (self, name, f[name])
+                n = self.n_metabs
+                self.stoich = scipy.sparse.csc_matrix (
+                    (self.coefs, (self.rows, self.cols)),
+                    shape=(n, len(self.fast)))
+                self.sparsity = scipy.sparse.csr_matrix (
+                    (np.ones (len(f['sp_indices']), dtype=bool),
+                     f['sp_indices'], f['sp_indptr']), shape=(n,n))
+        except (OSError, KeyError, ValueError):
+            return (False)
+        return (True)
+
+    # Save the cached arrays to 'path' (see write_atomic()). The cache is only
+    # an optimization, so if that fails we just carry on without it.
+    def save (self, path):
+        import os
+        try:
+            os.makedirs (os.path.dirname (path) or '.', exist_ok=True)
+        except OSError:
+            return (False)
+        return (write_atomic (path, lambda f: np.savez (f,
+                                sp_indices=self.sparsity.indices,
+                                sp_indptr=self.sparsity.indptr,
+                                **{name: getattr (self, name)
+                                   for name in self.cached_arrays})))
+
+    # Build the index arrays, the stoichiometry and the Jacobian's structure
+    # from scratch.
+    def build (self, consumes):
+        n_metabs = self.n_metabs
+        n_fast = len(self.fast)
+
+        # Reactant and product index arrays, one row per reaction. Short rows
+        # are padded with index n_metabs, which rhs() points at a constant 1.0
+        # so that it drops out of the products.
+        max_in  = max ([len(r.inputs)  for r in self.fast], default=0)
+        max_out = max ([len(r.outputs) for r in self.fast], default=0)
+        self.in_idx  = np.full ((n_fast, max_in),  n_metabs, dtype=np.intp)
+        self.out_idx = np.full ((n_fast, max_out), n_metabs, dtype=np.intp)
+        for j,r in enumerate(self.fast):
+            self.in_idx [j, :len(r.inputs)]  = r.inputs
+            self.out_idx[j, :len(r.outputs)] = r.outputs
+
+        # Stoichiometry matrix: d(metab)/dt = stoich @ v. It is a sparse
+        # (CSC) matrix, since each reaction touches only a few of what may be
+        # tens of thousands of metabolites. A metabolite can appear more than
+        # once in a reaction, so the entries are summed; one that a reaction
+        # both consumes and produces nets out to nothing.
+        import scipy.sparse
+        rows=[]; cols=[]; coefs=[]
+        for j,r in enumerate(self.fast):
+            rows += r.outputs; cols += [j]*len(r.outputs)
+            coefs += [1.0]*len(r.outputs)
+            if (consumes[j]):
+                rows += r.inputs; cols += [j]*len(r.inputs)
+                coefs += [-1.0]*len(r.inputs)
+        self.stoich = scipy.sparse.csc_matrix (
+            (np.array (coefs, dtype=float),
+             (np.array (rows, dtype=np.intp), np.array (cols, dtype=np.intp))),
+            shape=(n_metabs, n_fast))
+        self.stoich.eliminate_zeros()
+
+        # The same matrix in coordinate form, which is what rhs() scatters with.
+        coo = self.stoich.tocoo()
+        self.rows = coo.row.astype (np.intp)
+        self.cols = coo.col.astype (np.intp)
+        self.coefs = coo.data
+        self.compile_jacobian()
+
+    # Precompute the structure of the Jacobian of the vectorized reactions.
+    # d(v_j)/d(y_k) is kF_j times the product of reaction j's other inputs if
+    # k is an input, and -kR_j times the product of its other outputs if k is
+    # an output. rates_partials() returns those as one array with a column
+    # per input slot and then per output slot. Each Jacobian entry J[m,k] is
+    # then a sum of stoich[m,j] * partials[j,slot] over the (j,slot) that
+    # point at metabolite k.
+    def compile_jacobian (self):
+        n = self.n_metabs
+        idx = np.hstack ((self.in_idx, self.out_idx))
+        n_slots = idx.shape[1]
+        S = self.stoich
+        jm=[]; jk=[]; jc=[]; jd=[]
+        for j in range(len(self.fast)):
+            # Column j's nonzeros, straight out of the CSC arrays.
+            rows  = S.indices [S.indptr[j]:S.indptr[j+1]]
+            coefs = S.data    [S.indptr[j]:S.indptr[j+1]]
+            for slot in range(n_slots):
+                k = idx[j,slot]
+                if (k == n):	# padding
+                    continue
+                jm.extend (rows); jk.extend ([k]*len(rows))
+                jc.extend (coefs); jd.extend ([j*n_slots+slot]*len(rows))
+        self.jac_rows  = np.array (jm, dtype=np.intp)
+        self.jac_cols  = np.array (jk, dtype=np.intp)
+        self.jac_coefs = np.array (jc, dtype=float)
+        self.jac_slots = np.array (jd, dtype=np.intp)
+
+        # The slow reactions may touch any of their inputs and outputs.
+        pm=list(jm); pk=list(jk)
+        for r in self.slow:
+            touched = r.inputs + r.outputs
+            for m in touched:
+                for k in touched:
+                    pm.append (m); pk.append (k)
+        import scipy.sparse
+        self.sparsity = scipy.sparse.csr_matrix (
+            (np.ones (len(pm), dtype=bool), (pm, pk)), shape=(n,n))
+
+    # d(v_j)/d(y_k) for every reaction j and every input and output slot.
+    # Like rates(), 'y' may also be a stack of replicas.
+    def rates_partials (self, y, kF=None, kR=None):
+        kF = self.kF if (kF is None) else kF
+        kR = self.kR if (kR is None) else kR
+        y1 = append_one (y)
+        cols = []
+        for idx,k in ((self.in_idx,kF), (self.out_idx,-kR)):
+            vals = y1[..., idx]
+            for slot in range(idx.shape[1]):
+                others = np.delete (vals, slot, axis=-1)
+                cols.append (k * others.prod(axis=-1))
+        if (len(cols) == 0):
+            return (np.zeros (y.shape[:-1] + (len(self.fast), 0)))
+        return (np.stack (cols, axis=-1))
+
+    # The Jacobian d(yprime)/d(y) in coordinate form (rows, cols, values);
+    # duplicate (row,col) pairs must be summed.
+    def jacobian_coo (self, y, t):
+        rows, cols, vals = self.jacobian_coo_batch (y[np.newaxis], t)
+        return (rows, cols, vals[0])
+
+    # The same for a stack of replicas Y (one row each), with per-replica rate
+    # constants kF and kR and parameters 'params' (see rhs_batch()). Every
+    # replica has the same (rows, cols) structure, so 'vals' has one row per
+    # replica.
+    def jacobian_coo_batch (self, Y, t, kF=None, kR=None, params=None):
+        n_rep = Y.shape[0]
+        partials = self.rates_partials (Y, kF, kR).reshape (n_rep, -1)
+        vals = self.jac_coefs * partials[:, self.jac_slots]
+        rows=[self.jac_rows]; cols=[self.jac_cols]; allVals=[vals]
+        for r in self.slow:
+            touched = r.inputs + r.outputs
+            P = None if (params is None) else params.get (r)
+            if (getattr (r.gate, 'batch', False)
+                    and (getattr (r.gate, 'jac', None) is not None)):
+                sides = reaction_jac_batch (r, Y, t,
+                                            None if (P is None) else list (P.T))
+            else:
+                blocks = [reaction_jac (r, y, t,
+                                        None if (P is None) else list (P[p]))
+                          for p,y in enumerate(Y)]
+                sides = [np.array ([np.asarray (b[side], dtype=float).ravel()
+                                    for b in blocks]) for side in (0,1)]
+            for side,metabs in ((0,r.inputs), (1,r.outputs)):
+                if (sides[side].size == 0):
+                    continue
+                rows.append (np.repeat (metabs, len(touched)))
+                cols.append (np.tile (touched, len(metabs)))
+                allVals.append (sides[side])
+        return (np.concatenate(rows), np.concatenate(cols),
+                np.concatenate(allVals, axis=1))
+
+    def jacobian (self, y, t):
+        import scipy.sparse
+        rows, cols, vals = self.jacobian_coo (y, t)
+        n = self.n_metabs
+        return (scipy.sparse.csc_matrix ((vals, (rows, cols)), shape=(n,n)))
+
+    def jacobian_dense (self, y, t):
+        rows, cols, vals = self.jacobian_coo (y, t)
+        n = self.n_metabs
+        return (np.bincount (rows*n+cols, weights=vals,
+                             minlength=n*n).reshape (n,n))
+
+    # Conservation laws: each row c of the returned matrix L has c@yprime=0
+    # no matter what the state is, so c@y never changes. A metabolite that no
+    # reaction changes (e.g., one that is held constant) is its own law.
+    # The vectorized reactions' stoichiometry is known exactly; each other
+    # reaction is assumed able to change any metabolite it slews, so laws
+    # never involve those metabolites.
+    # Also returns, for each law, a "pivot" metabolite whose d/dt equation is
+    # redundant given the others.
+    # This takes a dense SVD of the stoichiometry, so it (and mode='root',
+    # steady-state sensitivities and sim_continuation, which use it)
+    # does not scale to the largest networks the way run_sim() does.
+    def conservation_laws (self):
+        import scipy.linalg
+        touched = np.zeros ((self.n_metabs, 0))
+        for r in self.slow:
+            for m in r.inputs + r.outputs:
+                col = np.zeros ((self.n_metabs, 1)); col[m] = 1
+                touched = np.hstack ((touched, col))
+        S = np.hstack ((self.stoich.toarray(), touched))
+        L = scipy.linalg.null_space (S.T).T
+        if (L.shape[0] == 0):
+            return (L, np.zeros (0, dtype=np.intp))
+        _,_,perm = scipy.linalg.qr (L, pivoting=True)
+        return (L, perm[:L.shape[0]])
+
+    def initial_state (self, initVal):
+        return (initVal)
+
+    # Column j of the stoichiometry matrix (vectorized reaction j's effect on
+    # every metabolite), as a dense vector.
+    def stoich_column (self, j):
+        S = self.stoich
+        lo, hi = S.indptr[j], S.indptr[j+1]
+        col = np.zeros (self.n_metabs)
+        col[S.indices[lo:hi]] = S.data[lo:hi]
+        return (col)
+
+    # d(yprime)/dp for each (Reaction, paramIndex) pair in 'params'; one
+    # column per pair. For a vectorized reaction, params[0] is kF and
+    # params[1] is kR (see mass_action_form()). Other reactions get
+    # differentiated numerically.
+    def param_partials (self, y, t, params):
+        dfdp = np.zeros ((self.n_metabs, len(params)))
+        y1 = append_one (y)
+        for p,(r,idx) in enumerate(params):
+            if (r in self.fast):
+                j = self.fast.index (r)
+                col = self.stoich_column (j)
+                if (idx == 0):
+                    dfdp[:,p] = col * y1[self.in_idx[j]].prod()
+                else:
+                    dfdp[:,p] = -col * y1[self.out_idx[j]].prod()
+                continue
+            g_current.reaction = r
+            h = 1.49e-8 * max (1.0, abs(r.params[idx]))
+            bumped = list (r.params); bumped[idx] += h
+            for sign,prm in ((-1,r.params), (1,bumped)):
+                in_slews,out_slews = r.func (t, y[r.inputs].astype(float),
+                                             y[r.outputs].astype(float), prm)
+                for k,m in enumerate(r.outputs):
+                    dfdp[m,p] += sign*out_slews[k]/h
+                for k,m in enumerate(r.inputs if (len(in_slews)!=0) else []):
+                    dfdp[m,p] += sign*in_slews[k]/h
+        return (dfdp)
+
+    # Reload the rate constants from the reactions' params[], so that callers
+    # can keep tweaking params[] between simulations (run_xfer_curve does).
+    def refresh_params (self):
+        for j,r in enumerate(self.fast):
+            self.kF[j], self.kR[j], _ = mass_action_form (r)
+
+    # The net rate of every vectorized reaction.
+    # 'y' may also be a 2D stack of replicas, one per row; then the result
+    # has one row per replica too, and kF and kR (which default to the
+    # network's own) may give each replica its own rate constants.
+    def rates (self, y, kF=None, kR=None):
+        kF = self.kF if (kF is None) else kF
+        kR = self.kR if (kR is None) else kR
+        y1 = append_one (y)
+        return (kF*y1[..., self.in_idx].prod(axis=-1)
+                - kR*y1[..., self.out_idx].prod(axis=-1))
+
+    def rhs (self, y, t):
+        assert (y.size == self.n_metabs)
+        if (self.profile is not None):
+            return (self.rhs_profiled (y, t))
+        if (len(self.rows) != 0):
+            v = self.rates (y)
+            yprime = np.bincount (self.rows, weights=self.coefs*v[self.cols],
+                                  minlength=self.n_metabs)
+        else:
+            yprime = np.zeros (self.n_metabs)
+        if (len(self.slow) != 0):
+            reactions_loop (y, t, self.slow, yprime)
+        return (yprime)
+
+    # rhs(), but timing each reaction into self.profile as it goes. The
+    # vectorized reactions all run at once, so they share one entry.
+    def rhs_profiled (self, y, t):
+        import time
+        prof = self.profile
+        prof.rhs_evals += 1
+        start = time.perf_counter()
+        if (len(self.rows) != 0):
+            v = self.rates (y)
+            yprime = np.bincount (self.rows, weights=self.coefs*v[self.cols],
+                                  minlength=self.n_metabs)
+            prof.add ('(%d vectorized)' % len(self.fast), start)
+        else:
+            yprime = np.zeros (self.n_metabs)
+        for r in self.slow:
+            start = time.perf_counter()
+            reactions_loop (y, t, [r], yprime)
+            prof.add (r.name, start)
+        return (yprime)
+
+    # rhs() for a stack of replicas Y, one per row. Row p of kF and kR holds
+    # replica p's rate constants (one column per vectorized reaction).
+    # The non-vectorized reactions are the same in every replica.
+    # 'params', if given, is a dict {Reaction: 2D array [replica, parameter]}
+    # that gives some of the non-vectorized reactions their own params[] in
+    # each replica.
+    # With a profile on, each replica counts as one evaluation.
+    def rhs_batch (self, Y, t, kF=None, kR=None, params=None):
+        import time
+        n_rep, n = Y.shape
+        prof = self.profile
+        if (prof is not None):
+            prof.rhs_evals += n_rep
+            start = time.perf_counter()
+        if (len(self.rows) != 0):
+            V = self.rates (Y, kF, kR)
+            where = (np.arange(n_rep)[:,np.newaxis]*n + self.rows).ravel()
+            Yprime = np.bincount (where, weights=(V[:,self.cols]*self.coefs)
+                                  .ravel(), minlength=n_rep*n).reshape (n_rep,n)
+            if (prof is not None):
+                prof.add ('(%d vectorized)' % len(self.fast), start, n_rep)
+        else:
+            Yprime = np.zeros ((n_rep, n))
+        for r in self.slow:
+            start = time.perf_counter()
+            P = None if (params is None) else params.get (r)
+            if (getattr (r.gate, 'batch', False)):
+                reaction_batch (r, Y, t, Yprime,
+                                None if (P is None) else list (P.T))
+            else:
+                for p in range(n_rep):
+                    reactions_loop (Y[p], t, [r], Yprime[p],
+                                    None if (P is None) else list (P[p]))
+            if (prof is not None):
+                prof.add (r.name, start, n_rep)
+        return (Yprime)
+
+# The forward-sensitivity system of a CompiledNetwork: the state followed by
+# dy/dp for each parameter p. It has the same rhs(), jacobian() and
+# jacobian_dense() as a CompiledNetwork, so run_sim() can integrate either.
+# 'params' is a list of (Reaction, paramIndex) pairs.
+class SensitivitySystem:
+    def __init__ (self, net, params):
+        self.net = net
+        self.params = params
+        self.n_metabs = net.n_metabs
+
+    def initial_state (self, initVal):
+        # The initial values do not depend on any of the parameters.
+        return (np.concatenate ((np.asarray (initVal, dtype=float),
+                                 np.zeros (self.n_metabs*len(self.params)))))
+
+    # Split integration results into the states and the sensitivities,
+    # indexed [timepoint, metabolite, parameter].
+    def split (self, z):
+        n = self.n_metabs
+        S = z[:,n:].reshape (len(z), len(self.params), n).transpose (0,2,1)
+        return (z[:,:n], S)
+
+    def rhs (self, z, t):
+        n = self.n_metabs
+        y = z[:n]; S = z[n:].reshape (len(self.params), n).T
+        dS = self.net.jacobian (y,t) @ S + self.net.param_partials (y,t,
+                                                                  self.params)
+        return (np.concatenate ((self.net.rhs (y,t), dS.T.ravel())))
+
+    # We ignore how J itself depends on y, which leaves a block-diagonal
+    # matrix with J on the diagonal. That only slows the solver's Newton
+    # iterations down a bit; it does not change the answer.
+    def jacobian (self, z, t):
+        import scipy.sparse
+        J = self.net.jacobian (z[:self.n_metabs], t)
+        return (scipy.sparse.block_diag ([J]*(len(self.params)+1), format='csc'))
+
+    def jacobian_dense (self, z, t):
+        J = self.net.jacobian_dense (z[:self.n_metabs], t)
+        return (np.kron (np.eye (len(self.params)+1), J))
+
+# Where the time goes, per reaction. While a network's profile is on, every
+# derivative evaluation adds to
+#	calls[name]:	how many times reaction 'name' was evaluated.
+#	seconds[name]:	the total wall time that took.
+#	rhs_evals:	the total number of derivative evaluations.
+#	runs:		how many derivative evaluations each solver run took.
+# A solver run is one call of run_sim(), run_sim_reduced() (its reduced
+# simulation; the full one it compares against is a run_sim()),
+# run_ensemble(), run_xfer_curve() or run_xfer_continuation(); or, within
+# steady_state_sim(), each run_sim() of mode='restart', the one solver of
+# mode='continue', and the root finding of mode='root'. An ensemble of n
+# replicas counts n evaluations per step, but the workers of
+# run_ensemble(processes>1) keep their counts to themselves. The stochastic
+# simulations (sim_stochastic) never evaluate derivatives, so they are not
+# profiled. Reactions that share a name share an entry.
+class Profile:
+    def __init__ (self):
+        self.calls = {}; self.seconds = {}
+        self.rhs_evals = 0; self.runs = []
+
+    # Charge reaction 'name' with 'n' calls (one per replica of an
+    # ensemble), which began at time 'start'.
+    def add (self, name, start, n=1):
+        import time
+        self.calls[name] = self.calls.get (name, 0) + n
+        self.seconds[name] = (self.seconds.get (name, 0.0)
+                              + time.perf_counter() - start)
+
+    def begin_run (self):
+        self.run_start = self.rhs_evals
+
+    def end_run (self):
+        self.runs.append (self.rhs_evals - self.run_start)
+
+    # A table with one row per reaction, slowest first.
+    def report (self):
+        total = sum (self.seconds.values())
+        lines = ['%-24s %10s %10s %9s %6s' % ('reaction', 'calls', 'seconds',
+                                              'us/call', '%time')]
+        for name in sorted (self.seconds, key=self.seconds.get, reverse=True):
+            n = self.calls[name]; sec = self.seconds[name]
+            lines.append ('%-24s %10d %10.4f %9.2f %6.1f' % (name, n, sec,
+                          1e6*sec/n, 100*sec/total if total else 0))
+        lines.append ('%d derivative evaluations in %d solver runs: %s'
+                      % (self.rhs_evals, len(self.runs), self.runs))
+        return ('\n'.join (lines))
+
+# What the ODE solvers say about their work; see run_sim(). Every solver call
+# that gets one of these as its 'stats' adds a dict to .runs, with
+#	method, t0, t1:	the solver and the time span it covered.
+#	rhs_evals:	derivative evaluations.
+#	jac_evals:	Jacobian evaluations.
+#	lu_decomps:	LU factorizations (solve_ivp's solvers only).
+#	steps:		integration steps (not given by solve_ivp).
+#	switches:	how often LSODA switched between its non-stiff (Adams)
+#			and stiff (BDF) methods, as seen at each output timepoint.
+#	min_step, max_step: the step sizes (for LSODA, the ones in use at each
+#			output timepoint).
+#	message:	how the solver said it ended, if it did.
+# and to the totals of each count (leaving out what a solver didn't give),
+# plus .calls. Many evaluations per unit of time, many Jacobians per step
+# and tiny steps mark a stiff problem; many switches a problem that keeps
+# changing character; and few steps over a long span, one that is merely
+# long.
+class SolverStats:
+    COUNTS = ('rhs_evals', 'jac_evals', 'lu_decomps', 'steps', 'switches')
+
+    def __init__ (self):
+        self.runs = []; self.calls = 0; self.cache_hits = 0
+        for key in self.COUNTS:
+            setattr (self, key, 0)
+        self.min_step = None; self.max_step = None
+        self.settle_times = None	# set by run_xfer_curve()
+
+    def add (self, method, t0, t1, rhs_evals, jac_evals, lu_decomps=None,
+             steps=None, switches=None, step_sizes=(), message=None):
+        run = {'method':method, 't0':float(t0), 't1':float(t1)}
+        for key,val in zip (self.COUNTS, (rhs_evals, jac_evals, lu_decomps,
+                                          steps, switches)):
+            run[key] = None if (val is None) else int(val)
+            if (val is not None):
+                setattr (self, key, getattr (self, key) + int(val))
+        sizes = np.asarray (step_sizes, dtype=float)
+        sizes = sizes[sizes > 0]
+        run['min_step'] = float (sizes.min()) if len(sizes) else None
+        run['max_step'] = float (sizes.max()) if len(sizes) else None
+        if (len(sizes)):
+            self.min_step = min (run['min_step'], self.min_step or np.inf)
+            self.max_step = max (run['max_step'], self.max_step or 0)
+        run['message'] = message
+        self.runs.append (run); self.calls += 1
+
+    # Add an odeint() call over timePts, from its full_output 'info'. Its
+    # counts are cumulative, per output timepoint; mused is 1 for Adams and
+    # 2 for BDF, starting with Adams.
+    def add_odeint (self, info, timePts, method='LSODA'):
+        mused = np.concatenate (([1], info['mused']))
+        mused = mused[mused > 0]	# (0 past where a failed call stopped)
+        self.add (method, timePts[0], timePts[-1], info['nfe'][-1],
+                  info['nje'][-1], None, info['nst'][-1],
+                  np.count_nonzero (np.diff (mused)), info['hu'],
+                  info['message'])
+
+    # Add a solve_ivp() call from its result 'sol'.
+    def add_ivp (self, sol, method, t0, t1):
+        self.add (method, t0, t1, sol.nfev, sol.njev, sol.nlu,
+                  message=sol.message)
+
+    # The totals, and then one line per call.
+    def report (self):
+        fmt = lambda v, f: ('%10s' % '-') if (v is None) else (f % v)
+        lines = ['%-8s %10s %10s %10s %10s %10s %8s %10s %10s'
+                 % ('method', 't0', 't1', 'rhs', 'jac', 'lu', 'steps',
+                    'min_step', 'max_step')]
+        for r in self.runs:
+            lines.append ('%-8s %10.4g %10.4g %10d %10d %s %s %s %s'
+                          % (r['method'], r['t0'], r['t1'], r['rhs_evals'],
+                             r['jac_evals'], fmt (r['lu_decomps'], '%10d'),
+                             fmt (r['steps'], '%8d'),
+                             fmt (r['min_step'], '%10.3g'),
+                             fmt (r['max_step'], '%10.3g')))
+        lines.append ('%d solver calls (%d cache hits): %d derivative '
+                      'evaluations, %d Jacobians, %d LU, %d steps, '
+                      '%d method switches'
+                      % (self.calls, self.cache_hits, self.rhs_evals,
+                         self.jac_evals, self.lu_decomps, self.steps,
+                         self.switches))
+        return ('\n'.join (lines))
+
+# What save_network() writes into every file, so that load_network() can tell
+# its files (and their version) apart from anything else.
+NETWORK_FORMAT = 'sim_infrastructure network v1'
+
+def check_format (fmt, path):
+    if (fmt != NETWORK_FORMAT):
+        raise ValueError ('load_network: '+path+' is not a saved network (or '
+                          + 'is from an incompatible version)')
+
+# A dict from each name in 'names' to its index; as in add_metab(), a
+# repeated name keeps its first index.
+def first_index (names):
+    index = {}
+    for i,name in enumerate(names):
+        index.setdefault (name, i)
+    return (index)
+
+# The name that save_network() records for reaction r's function:
+# 'module.function'.
+def gate_name (r):
+    name = gate_path (r.gate)
+    if (name is None):
+        raise ValueError ('save_network: the function of reaction '+r.name
+                          +' is not a module-level function, so it cannot be '
+                          +'saved by name')
+    return (name)
+
+# The 'module.qualname' of function f, or None if that does not identify it
+# (a lambda, closure or nested function, whose qualname has a '<locals>').
+def gate_path (f):
+    module = getattr (f, '__module__', None)
+    qual = getattr (f, '__qualname__', '')
+    if ((module is None) or ('<' in qual) or (qual == '')):
+        return (None)
+    return (module + '.' + qual)
+
+# Raise ValueError unless 'g' (from the file 'path') indexes one of n_gates
+# gates. Python would take a negative index from the end.
+def check_gate_index (g, n_gates, path):
+    if ((type(g) is not int) or (g < 0) or (g >= n_gates)):
+        raise ValueError ('load_network: '+path+' has a gate index out of '
+                          + 'range: '+str(g))
+
+# The function that gate_name() named, importing its module if need be.
+# Importing it runs the module's code.
+def find_gate (name):
+    import importlib, sys
+    module, _, qual = name.rpartition ('.')
+    mod = sys.modules.get (module)
+    if (mod is None):
+        mod = importlib.import_module (module)
+    f = mod
+    for part in qual.split ('.'):
+        f = getattr (f, part)
+    return (f)
+
+# Write a file through 'write' (a function of the open binary file), under a
+# unique temporary name in the same directory, and then rename it to 'path'.
+# So another thread or process never reads a half-written file, and two
+# writing the same file at once each rename their own complete copy. Returns
+# False (and leaves nothing behind) if it fails.
+def write_atomic (path, write):
+    import os, tempfile
+    try:
+        fd, tmp = tempfile.mkstemp (suffix='.tmp',
+                                    dir=os.path.dirname (path) or '.')
+    except OSError:
+        return (False)
+    try:
+        with os.fdopen (fd, 'wb') as f:
+            write (f)
+        os.replace (tmp, path)
+    except OSError:
+        try:
+            os.remove (tmp)
+        except OSError:
+            pass
+        return (False)
+    return (True)
+
+# Integrate the compiled network (or SensitivitySystem) 'net' from the state
+# 'y0' at time timePts[0], and return its state at each of timePts as a 2D
+# array [timepoint, metabolite]. 'method', 'rtol' and 'atol' are as for
+# run_sim().
+# 'breaks' are times where the derivatives have corners (see
+# Network.breakpoints()). Each smooth piece between them gets integrated on
+# its own, so the solver restarts at every corner instead of stepping across
+# it.
+# Each solver call adds its statistics to 'stats', if it's a SolverStats.
+def integrate (net, y0, timePts, method='LSODA', rtol=None, atol=None,
+               breaks=(), stats=None):
+    import scipy.integrate
+
+    if (len (smooth_pieces (timePts, breaks)) > 1):
+        y = np.empty ((len(timePts), len(y0)))
+        y[0] = y0
+        for a,b,idx in smooth_pieces (timePts, breaks):
+            pts = np.unique (np.concatenate (([a], timePts[idx], [b])))
+            piece = integrate (net, y0, pts, method, rtol, atol, (), stats)
+            y[idx] = piece[np.searchsorted (pts, timePts[idx])]
+            y0 = piece[-1]
+        return (y)
+
+    if (method == 'LSODA'):
+        # odeint inputs:
+        #   - function that we supply, which must return state-variable
+        #     derivatives (and, optionally, one that returns its Jacobian)
+        #   - initial values of state variables (and the size of this 1D
+        #     array tells odeint how many state variables there are).
+        #   - an array of the times when we want the DFQ solved.
+        # odeint outputs: just one, a 2D array with
+        #   - one row per requested timepoint
+        #   - one column per metabolite
+        # (With full_output, it also returns a dict of its statistics.)
+        if (stats is None):
+            return (scipy.integrate.odeint (net.rhs, y0, timePts,
+                                            Dfun=net.jacobian_dense,
+                                            rtol=rtol, atol=atol))
+        y, info = scipy.integrate.odeint (net.rhs, y0, timePts,
+                                          Dfun=net.jacobian_dense,
+                                          rtol=rtol, atol=atol,
+                                          full_output=True)
+        stats.add_odeint (info, timePts)
+        return (y)
+    if (method in ('BDF', 'Radau')):
+        rtol0, atol0 = default_tols (method)
+        sol = scipy.integrate.solve_ivp (
+                lambda t,y: net.rhs (y,t), (timePts[0], timePts[-1]), y0,
+                method=method, t_eval=timePts,
+                jac=lambda t,y: net.jacobian(y,t),
+                rtol=(rtol0 if rtol is None else rtol),
+                atol=(atol0 if atol is None else atol))
+        if (stats is not None):
+            stats.add_ivp (sol, method, timePts[0], timePts[-1])
+        if (not sol.success):
+            raise RuntimeError ('run_sim: '+method+' failed: '+sol.message)
+        return (sol.y.T)
+    raise ValueError ('run_sim: unknown method '+str(method))
+
+# Something that may happen partway through a simulation; see run_sim().
+#	kind='level':	metabolite 'metab' (a name) crosses 'value'.
+#	kind='rate':	its d/dt crosses 'value'.
+#	kind='settle':	the size of its d/dt falls below 'value'.
+# 'direction' is as for scipy's solve_ivp: +1 counts only crossings upwards,
+# -1 only downwards and 0 both (a 'settle' event is always downwards). A
+# 'terminal' event stops the simulation; any other just gets its times
+# recorded.
+class Event:
+    def __init__ (self, metab, value, kind='level', direction=0,
+                  terminal=True):
+        if (kind not in ('level', 'rate', 'settle')):
+            raise ValueError ('Event: unknown kind '+str(kind))
+        self.metab = metab
+        self.value = value
+        self.kind = kind
+        self.direction = direction
+        self.terminal = terminal
+
+    # The function of (t,y) whose zeros are the event, for the compiled
+    # network (or SensitivitySystem) 'net' in which our metabolite is number
+    # 'm'. It carries the terminal and direction attributes that solve_ivp
+    # looks for.
+    def function (self, net, m):
+        value = self.value
+        if (self.kind == 'level'):
+            f = lambda t,y: y[m] - value
+        elif (self.kind == 'rate'):
+            f = lambda t,y: net.rhs (y,t)[m] - value
+        else:
+            f = lambda t,y: abs (net.rhs (y,t)[m]) - value
+        f.terminal = self.terminal
+        f.direction = -1 if (self.kind == 'settle') else self.direction
+        return (f)
+
+# integrate(), but watching for events. 'funcs' are event functions from
+# Event.function(). odeint cannot look for events, so LSODA runs through
+# solve_ivp here (with the same tolerances and the dense Jacobian), which
+# locates each event by root finding between the solver's steps.
+# Returns (timePts, y, tEvents): if a terminal event stopped the run, only
+# the timepoints before it are left, and the event's own time and state
+# are appended. tEvents holds, for each event, an array of its times.
+# As in integrate(), each smooth piece between the 'breaks' is a fresh solve,
+# and each one adds its statistics to 'stats' (if given).
+def integrate_events (net, y0, timePts, method, rtol, atol, funcs,
+                      breaks=(), stats=None):
+    import scipy.integrate
+    y0 = np.asarray (y0, dtype=float)
+    rtol0, atol0 = default_tols (method)
+    jac = net.jacobian_dense if (method == 'LSODA') else net.jacobian
+    ts = [timePts[:1]]; ys = [y0[np.newaxis]]
+    tEvents = [[] for f in funcs]
+    for a,b,idx in smooth_pieces (timePts, breaks):
+        # Also stop at b itself, to restart the next piece from there.
+        pts = np.unique (np.append (timePts[idx], b))
+        sol = scipy.integrate.solve_ivp (
+                lambda t,y: net.rhs (y,t), (a, b), y0,
+                method=solver_class(method), t_eval=pts,
+                jac=lambda t,y: jac(y,t), events=funcs,
+                rtol=(rtol0 if rtol is None else rtol),
+                atol=(atol0 if atol is None else atol))
+        if (stats is not None):
+            stats.add_ivp (sol, method, a, b)
+        if (sol.status == -1):
+            raise RuntimeError ('run_sim: '+method+' failed: '+sol.message)
+        # (If it stopped before its first timepoint, these come back as
+        # empty lists.)
+        t = np.asarray (sol.t)
+        y = np.asarray (sol.y, dtype=float).reshape (len(y0), len(t)).T
+        keep = np.isin (t, timePts[idx])
+        ts.append (t[keep]); ys.append (y[keep])
+        for k,te in enumerate(sol.t_events):
+            # A piece that starts right on an event can report it again.
+            tEvents[k] += [e for e in te
+                           if ((len(tEvents[k]) == 0) or (e > tEvents[k][-1]))]
+        if (sol.status == 1):	# a terminal event stopped it
+            stops = [(te[-1], ye[-1]) for f,te,ye in
+                     zip (funcs, sol.t_events, sol.y_events)
+                     if (f.terminal and (len(te) != 0))]
+            tStop, yStop = max (stops, key=lambda s: s[0])
+            if (tStop > np.concatenate (ts)[-1]):
+                ts.append ([tStop]); ys.append (yStop[np.newaxis])
+            break
+        y0 = sol.y[:,-1]
+    return (np.concatenate (ts), np.concatenate (ys),
+            [np.array (te) for te in tEvents])
+
+# Split the span of timePts at the 'breaks' that fall inside it. Returns a
+# list of (start, end, idx) for each piece, where idx are the indices of the
+# timepoints in (start, end] that it must report.
+def smooth_pieces (timePts, breaks):
+    timePts = np.asarray (timePts)
+    t0, t1 = timePts[0], timePts[-1]
+    edges = [t0] + [b for b in sorted (set (breaks)) if (t0 < b < t1)] + [t1]
+    return ([(a, b, np.nonzero ((timePts > a) & (timePts <= b))[0])
+             for a,b in zip (edges[:-1], edges[1:])])
+
+# Simulation results kept on disk, so that long runs need not fit in memory.
+# A store is a directory holding
+#	t.npy:		the timepoints.
+#	y.npy:		the results, indexed [timepoint, metabolite].
+#	metabs.json:	the metabolite names, in the order of y's columns.
+# .t and .y are numpy memmaps of the two arrays, so that indexing them (e.g.,
+# y[-1] or y[:,3]) reads only the part of the file that it needs.
+class ResultStore:
+    def __init__ (self, path, mode='r'):
+        import os, json
+        self.path = path
+        with open (os.path.join (path, 'metabs.json')) as f:
+            self.metabs = json.load (f)
+        self.t = np.load (os.path.join (path, 't.npy'), mmap_mode=mode)
+        self.y = np.load (os.path.join (path, 'y.npy'), mmap_mode=mode)
+
+    # Make a new store (replacing any old one at 'path'), with room for
+    # results at each of 'timePts'.
+    @staticmethod
+    def create (path, metabs, timePts):
+        import os, json
+        os.makedirs (path, exist_ok=True)
+        with open (os.path.join (path, 'metabs.json'), 'w') as f:
+            json.dump (list (metabs), f)
+        np.save (os.path.join (path, 't.npy'), timePts)
+        y = np.lib.format.open_memmap (os.path.join (path, 'y.npy'), mode='w+',
+                                       shape=(len(timePts), len(metabs)))
+        del y
+        return (ResultStore (path, mode='r+'))
+
+    def column (self, metab):
+        try:
+            return (self.y[:, self.metabs.index (metab)])
+        except ValueError:
+            raise LookupError ('** There is no metabolite named ' + metab +'**')
+
+    def final_val (self, metab):
+        return (self.column (metab)[-1])
+
+# Open the results that run_sim(..., store=path) left in 'path'.
+def load_results (path):
+    return (ResultStore (path))
+
+# Append a constant 1 to the (last axis of the) state, for the padding index
+# in CompiledNetwork's index arrays.
+def append_one (y):
+    if (y.ndim == 1):
+        return (np.append (y, 1.0))
+    return (np.concatenate ((y, np.ones (y.shape[:-1]+(1,))), axis=-1))
+
+# The derivatives of one (non-vectorized) reaction's slews, in the format of
+# the sim_library derivative hooks: [d_in, d_out], with one column per input
+# and then one per output. Uses the reaction function's .jac hook if it has
+# one, and otherwise differentiates just this one reaction numerically.
+# 'params' (by default, r.params) are the reaction's parameters.
+def reaction_jac (r, y, t, params=None):
+    g_current.reaction = r
+    params = r.params if (params is None) else params
+    inputs  = y[r.inputs].astype(float)
+    outputs = y[r.outputs].astype(float)
+    hook = getattr (r.gate, 'jac', None)
+    if (hook is not None):
+        return (hook (t, inputs, outputs, params))
+
+    n_in = len(inputs)
+    vals = np.concatenate ((inputs, outputs))
+    in0,out0 = r.func (t, inputs, outputs, params)
+    d_in  = np.zeros ((len(in0),  len(vals)))
+    d_out = np.zeros ((len(out0), len(vals)))
+    for k in range(len(vals)):
+        h = 1.49e-8 * max (1.0, abs(vals[k]))
+        v = vals.copy(); v[k] += h
+        in1,out1 = r.func (t, v[:n_in], v[n_in:], params)
+        if (len(in0) != 0):
+            d_in[:,k] = (np.asarray(in1) - np.asarray(in0)) / h
+        d_out[:,k] = (np.asarray(out1) - np.asarray(out0)) / h
+    return (d_in, d_out)
+
+# Evaluate a reaction whose function has .batch set for every replica in Y
+# (one per row) at once, and accumulate its slews into Yprime. 'params', if
+# given, replaces r.params; each of its entries may be an array of that
+# parameter's value in every replica.
+def reaction_batch (r, Y, t, Yprime, params=None):
+    g_current.reaction = r
+    params = r.params if (params is None) else params
+    in_slews,out_slews = r.func (t, Y[:,r.inputs].T, Y[:,r.outputs].T, params)
+    for idx,met_idx in enumerate(r.outputs):
+        Yprime[:,met_idx] += out_slews[idx]
+    for idx,met_idx in enumerate(r.inputs if (len(in_slews)!=0) else []):
+        Yprime[:,met_idx] += in_slews[idx]
+
+# reaction_jac() for every replica in Y at once, using a .batch gate's .jac
+# hook. Returns the input-slew and output-slew derivatives, each flattened to
+# one row per replica. 'params' is as for reaction_batch().
+def reaction_jac_batch (r, Y, t, params=None):
+    g_current.reaction = r
+    params = r.params if (params is None) else params
+    n_rep = Y.shape[0]
+    d_in, d_out = r.gate.jac (t, Y[:,r.inputs].T, Y[:,r.outputs].T, params)
+    sides = []
+    for block in (d_in, d_out):
+        vals = [[np.broadcast_to (v, (n_rep,)) for v in row] for row in block]
+        sides.append (np.array (vals, dtype=float).reshape (-1, n_rep).T)
+    return (sides)
+
+########################################
+## Ensembles: many replicas of one network, each with its own state and rate
+## constants, integrated as one system. The replicas do not interact, so the
+## stacked Jacobian is block-diagonal; stored replica after replica, it is
+## banded with n_metabs-1 bands on either side, which odeint can exploit.
+
+# Integrate the replicas in Y0 (one per row) of compiled network 'net' over
+# timePts, which starts at the time of Y0. kF, kR and 'params' give each
+# replica its own rate constants and parameters (see
+# CompiledNetwork.rhs_batch()).
+# Returns a 3D array indexed [replica, timepoint, metabolite].
+# 'stats' and 'breaks' are as for integrate(); the whole ensemble is one call
+# per smooth piece.
+def integrate_ensemble (net, Y0, timePts, kF=None, kR=None, params=None,
+                        stats=None, breaks=()):
+    import scipy.integrate
+    Y0 = np.asarray (Y0, dtype=float)
+    n_rep, n = Y0.shape
+    timePts = np.asarray (timePts, dtype=float)
+
+    if (len (smooth_pieces (timePts, breaks)) > 1):
+        Y = np.empty ((n_rep, len(timePts), n))
+        Y[:,0] = Y0
+        for a,b,idx in smooth_pieces (timePts, breaks):
+            pts = np.unique (np.concatenate (([a], timePts[idx], [b])))
+            piece = integrate_ensemble (net, Y0, pts, kF, kR, params, stats)
+            Y[:,idx] = piece[:, np.searchsorted (pts, timePts[idx])]
+            Y0 = piece[:,-1]
+        return (Y)
+
+    def f (y, t):
+        return (net.rhs_batch (y.reshape (n_rep,n), t, kF, kR,
+                               params).ravel())
+
+    # The banded Jacobian for odeint: entry d(f_i)/d(y_j) lives at
+    # band[i-j+mu, j].
+    def band (y, t):
+        rows, cols, vals = net.jacobian_coo_batch (y.reshape (n_rep,n), t,
+                                                   kF, kR, params)
+        offs = np.arange(n_rep)[:,np.newaxis]*n
+        where = ((rows-cols+n-1)*(n_rep*n) + offs + cols).ravel()
+        return (np.bincount (where, weights=vals.ravel(),
+                    minlength=(2*n-1)*n_rep*n).reshape (2*n-1, n_rep*n))
+
+    if (stats is None):
+        y = scipy.integrate.odeint (f, Y0.ravel(), timePts, Dfun=band,
+                                    ml=n-1, mu=n-1)
+    else:
+        y, info = scipy.integrate.odeint (f, Y0.ravel(), timePts, Dfun=band,
+                                          ml=n-1, mu=n-1, full_output=True)
+        stats.add_odeint (info, timePts, 'LSODA x'+str(n_rep))
+    return (y.reshape (len(timePts), n_rep, n).transpose (1,0,2))
+
+# Integrate an ensemble (as for integrate_ensemble()) split into 'processes'
+# slices of replicas, each in its own worker process. The workers are forked,
+# so they inherit the job from g_ensemble_jobs (under a token of its own, so
+# that networks in other threads can run ensembles at the same time) instead
+# of having it pickled; reaction functions may be closures, which do not
+# pickle. Where there is no fork, or with processes=1, the job just runs
+# here. The lock only guards the parent's dict; the workers never take it.
+g_ensemble_jobs = {}
+g_ensemble_lock = threading.Lock()
+g_ensemble_tokens = itertools.count()
+
+def run_ensemble_slices (net, Y0, timePts, kF, kR, params, processes,
+                         breaks=()):
+    import multiprocessing
+    job = (net, Y0, timePts, kF, kR, params, breaks)
+    n_rep = Y0.shape[0]
+    processes = max (1, min (processes, n_rep))
+    if ('fork' not in multiprocessing.get_all_start_methods()):
+        processes = 1
+    if (processes == 1):
+        return (ensemble_slice (job, 0, n_rep))
+
+    from concurrent.futures import ProcessPoolExecutor
+    with g_ensemble_lock:
+        token = next (g_ensemble_tokens)
+        g_ensemble_jobs[token] = job
+    try:
+        bounds = np.linspace (0, n_rep, processes+1).astype (int)
+        with ProcessPoolExecutor (processes,
+                    mp_context=multiprocessing.get_context ('fork')) as pool:
+            parts = [pool.submit (ensemble_worker, token, lo, hi)
+                     for lo,hi in zip (bounds[:-1], bounds[1:])]
+            return (np.concatenate ([part.result() for part in parts]))
+    finally:
+        with g_ensemble_lock:
+            del g_ensemble_jobs[token]
+
+# What each worker runs: replicas lo..hi-1 of the job with this token.
+# It must not take g_ensemble_lock: the fork copies the lock as it was, and
+# if another thread held it then, the child would wait on it forever. Nor
+# does it need to; the child's copy of g_ensemble_jobs is its own, and the
+# token was in it before the fork.
+def ensemble_worker (token, lo, hi):
+    job = g_ensemble_jobs[token]
+    return (ensemble_slice (job, lo, hi))
+
+# Replicas lo..hi-1 of 'job', a tuple (net, Y0, timePts, kF, kR, params,
+# breaks) of integrate_ensemble()'s arguments.
+def ensemble_slice (job, lo, hi):
+    net, Y0, timePts, kF, kR, params, breaks = job
+    cut = lambda A: None if (A is None) else A[lo:hi]
+    if (params is not None):
+        params = {r:P[lo:hi] for r,P in params.items()}
+    return (integrate_ensemble (net, Y0[lo:hi], timePts, cut (kF), cut (kR),
+                                params, breaks=breaks))
+
+# steady_state_sim(mode='continue') for an ensemble. Each doubling of the
+# horizon continues from the previous end state, until every replica passes
+# steady_mask().
+# Returns (t, Y, OK): the final time, the final state of each replica (one
+# per row) and a Boolean per replica saying whether it reached steady state.
+# With 'stats', each doubling adds to it, and stats.settle_times gets the
+# horizon by which each replica was steady (inf if it never was).
+# 'breaks' are as for integrate().
+def ensemble_steady_state (net, Y0, tEndGuess, kF=None, kR=None, stats=None,
+                           breaks=()):
+    Y = np.asarray (Y0, dtype=float)
+    tPrev = 0; tEnd = tEndGuess
+    settled = np.full (len(Y), np.inf)
+    while (True):
+        Y = integrate_ensemble (net, Y, [tPrev, tEnd], kF, kR, stats=stats,
+                                breaks=breaks)[:,-1]
+        OK = steady_mask (Y, net.rhs_batch (Y, tEnd, kF, kR), tEnd)
+        settled[OK & np.isinf (settled)] = tEnd
+        if (stats is not None):
+            stats.settle_times = settled
+        if (OK.all() or (tEnd*2 > tEndGuess*1024)):
+            return (tEnd, Y, OK)
+        tPrev = tEnd; tEnd = tEnd*2
+
+# Is a steady state with Jacobian J (and conservation laws L, as returned by
+# CompiledNetwork.conservation_laws()) stable? It is iff every eigenvalue off
+# the conserved subspace has a negative real part. The laws contribute exact
+# zeros, so project them out.
+def is_stable (J, L):
+    if (L.shape[0] != 0):
+        import scipy.linalg
+        B = scipy.linalg.null_space (L)	# the free directions
+        J = B.T @ J @ B
+    return ((J.size == 0) or (np.max (np.linalg.eigvals(J).real) < 0))
+
+# The test itself. 'y' and 'yprime' may be stacks of replicas, one per row,
+# in which case this returns a Boolean per replica.
+def steady_mask (y, yprime, tEnd):
+    return (np.all ((np.abs(y) < .001) | (np.abs(yprime)*.1*tEnd < .01*np.abs(y)),
+                    axis=-1))
+
+# Above this many metabolites, method='auto' integrates with BDF and the
+# sparse Jacobian rather than LSODA and a dense one.
+SPARSE_METABS = 500
+
+# The integrator classes behind run_sim()'s 'method', and their default
+# tolerances (odeint's for LSODA).
+def solver_class (method):
+    import scipy.integrate
+    classes = {'LSODA':scipy.integrate.LSODA, 'BDF':scipy.integrate.BDF,
+               'Radau':scipy.integrate.Radau}
+    if (method not in classes):
+        raise ValueError ('Unknown integration method '+str(method))
+    return (classes[method])
+
+def default_tols (method):
+    return ((1.49012e-8, 1.49012e-8) if (method=='LSODA') else (1e-6, 1e-9))
 
 ########################################
 ## Functions for a reaction instance to save private data & get it back later
-## They rely on the fact that reactions_func() always uses g_current_reaction
-## to let us know which reaction is currently being evaluated.
+## They rely on the fact that the simulator always sets g_current.reaction to
+## let us know which reaction is currently being evaluated (in this thread).
 
 def write_my_space (memObj):
-    global g_current_reaction
-    r.memory = memObj
+    g_current.reaction.memory = memObj
 
-def read_my_space (memObj):
-    global g_current_reaction
-    return (r.memory)
+def read_my_space (memObj=None):
+    return (g_current.reaction.memory)
 
 ########################################
 ## Functions to implement memory of past state (e.g., a delay line).
 ## I.e., save away time-stamped data and then retrieve it
-## They maintain and use a list of TimeStampedData objects; each one has a time
-## stamp 't' and some data.
-## We assume that the objects are always in time-stamp order.
-class TimeStampedData:
-    t=0
-    data=None
-    def __init__ (self, T, D):
-        self.t=T; self.data=D
+## They maintain and use a StateHistory; it holds time stamps and data in
+## preallocated numpy arrays, always in time-stamp order, so lookups are a
+## binary search and saving is amortized O(1).
+## A reaction typically keeps its StateHistory in its private space:
+##	hist = si.read_my_space()
+##	if (hist is None):
+##	    hist = si.StateHistory(); si.write_my_space (hist)
+##	si.save_state_time (t, inputs[0], hist, how_long)
+##	old = si.get_state_time (t-delay, hist)
+## See sim_library.delay1() for a complete example.
+
+class StateHistory:
+    # 'capacity' is just the initial size; the arrays grow as needed.
+    def __init__ (self, capacity=1024):
+        self.times = np.zeros (capacity)
+        self.data = None	# allocated on the first save()
+        self.scalar = True	# whether save() was given scalars
+        self.start = 0		# the live entries are [start, end)
+        self.end = 0
+
+    def __len__ (self):
+        return (self.end - self.start)
+
+    # Record 'newData' (a number or a 1D array) at time 't', and forget
+    # anything older than t-how_long.
+    # ODE solvers evaluate reactions at times that can step backwards (e.g.,
+    # after a rejected step), so saving at time t first discards any entries
+    # stamped at or after t.
+    def save (self, t, newData, how_long=np.inf):
+        newData = np.asarray (newData, dtype=float)
+        if (self.data is None):
+            self.scalar = (newData.ndim == 0)
+            self.data = np.zeros ((len(self.times), newData.size))
+        live = self.times[self.start:self.end]
+        self.end = self.start + np.searchsorted (live, t, side='left')
+        self.start += np.searchsorted (self.times[self.start:self.end],
+                                       t-how_long, side='left')
+
+        # Out of room at the end: slide the live entries to the front, and
+        # double the arrays if they're more than half full.
+        if (self.end == len(self.times)):
+            n = len(self)
+            cap = len(self.times) * (2 if (2*n > len(self.times)) else 1)
+            times = np.zeros (cap); data = np.zeros ((cap, self.data.shape[1]))
+            times[:n] = self.times[self.start:self.end]
+            data[:n] = self.data[self.start:self.end]
+            self.times, self.data, self.start, self.end = times, data, 0, n
+
+        self.times[self.end] = t
+        self.data[self.end] = newData.ravel()
+        self.end += 1
+
+    # The data at time 't', interpolating linearly between the saved entries.
+    # Before the first entry (or after the last), return the first (last).
+    # With cubic=True, interpolate with a cubic through the four nearest
+    # entries instead. A linear interpolant has a kink at every entry, which
+    # keeps an ODE solver that feeds on it (e.g., through a delay line) to
+    # very small steps; the cubic is much smoother.
+    def get (self, t, cubic=False):
+        if (len(self) == 0):
+            raise LookupError ('** StateHistory is empty **')
+        times = self.times[self.start:self.end]
+        data = self.data[self.start:self.end]
+        i = np.searchsorted (times, t, side='right')
+        if (i == 0):
+            val = data[0]
+        elif (i == len(times)):
+            val = data[-1]
+        elif (cubic and (len(times) >= 4)):
+            lo = min (max (i-2, 0), len(times)-4)
+            tt = times[lo:lo+4]
+            # Lagrange weights for the four points.
+            w = np.array ([np.prod ([(t-tt[m])/(tt[j]-tt[m])
+                                     for m in range(4) if m != j])
+                           for j in range(4)])
+            val = w @ data[lo:lo+4]
+        else:
+            frac = (t - times[i-1]) / (times[i] - times[i-1])
+            val = data[i-1] + frac*(data[i] - data[i-1])
+        return (val[0] if self.scalar else val.copy())
 
 def save_state_time (t, newData, memObj, how_long=10000000):
-    assert (t > memObj[-1].t)		# Check that time stamps are in order
-    memObj.append (TimeStampedData (t, newData))	# add the new data
-    while (memObj[0].t < t-how_long):			# delete any old data
-        del memObj[0]
-
-# Find the item whose time stamp is closest to 't' and return it.
-def get_state_time (t, obj):
-    for obj in memObj:
-        if (obj.t > t):
-            break
-        bestObj = obj
-    return (obj if (obj.t-t < t-bestObj.t) else bestObj)
\ No newline at end of file
+    memObj.save (t, newData, how_long)
+
+# Return the data saved in 'memObj' at time 't' (interpolated; see
+# StateHistory.get()).
+def get_state_time (t, memObj, cubic=False):
+    return (memObj.get (t, cubic))
@@ -22,8 +22,55 @@
 # "Implies" gate: out = !a | b.
 # def imp1(t, inputs, outputs, params):
 # constitutive(): no inputs; always drives the output with a slew rate of .05
+# mass_action(): inputs <-> outputs, by the law of mass action.
+#	params: kF, kR
+# mass_action_held(): the same, but the inputs are held constant (i.e., the
+#	reaction does not consume them).
+#	params: kF, kR
+# delay1(): out follows in, delayed by a fixed time.
+#	params: delay, k
+# constDriver, mass_action and mass_action_held are vectorized by
+# sim_infrastructure.compile_sim(), so they are much faster than a
+# hand-written reaction function.
+#
+# Prepared gates.
+# A gate 'g' may have an attribute g.prepare(inputs, outputs, params), which
+# add_reaction() calls once for each new reaction (with its lists of input and
+# output indices, and its parameters). It checks them and returns the
+# function that the simulator should actually call; that one can skip the
+# checks and use anything precomputed from the parameters. The reaction keeps
+# the gate itself as .gate and the prepared function as .func; the hooks
+# below (.jac, .batch, .propensity) are always looked up on .gate.
+# Most of the gates here just call checkInputs() and then do arithmetic, so
+# check_once() makes their prepare hooks. If a prepared function is ever
+# handed some other params list than the one it was prepared with (e.g.,
+# when sim_infrastructure perturbs a parameter), or the same list edited in
+# place, it must still work.
+#
+# Breakpoints.
+# A gate whose output depends on time, and has corners (points where its
+# slope jumps), may have an attribute g.breakpoints(params), which returns
+# the times of those corners for a reaction with those parameters. Stepping
+# across a corner makes the integrator reject steps and shrink its step size,
+# or step right over a short pulse, so the simulators (run_sim(),
+# steady_state_sim() and the ensembles behind run_ensemble() and the transfer
+# curves) instead integrate up to each corner and restart there. pwl
+# has this hook. (sin has no corners, so it needs none.)
 ########################################
 
+import numpy as np
+
+# A prepare hook for a gate whose only set-up is checkInputs(): check the
+# reaction's shape once, and then just call 'fast'. nIn=None or nOut=None
+# accept any number of inputs or outputs.
+def check_once (fName, nIn, nOut, nParam, fast):
+    def prepare (inputs, outputs, params):
+        checkInputs (fName, len(inputs) if (nIn is None) else nIn,
+                     len(outputs) if (nOut is None) else nOut, nParam,
+                     inputs, outputs, params)
+        return (fast)
+    return (prepare)
+
 # Drive a node to a constant value.
 # Keep monitoring the node's current value and adjust accordingly.
 # No inputs
@@ -31,9 +78,11 @@
 # One parameter, which is the desired constant output concentration.
 def constDriver (t, inputs, outputs, params):
     checkInputs ('constDriver', 0,1,1, inputs, outputs, params)
-    assert ((len(inputs)==0) and (len(params)==1) and (len(outputs)==1))
-    desired = params[0]; current=outputs[0]
-    return ([[], [desired-current]])
+    return (constDriver_fast (t, inputs, outputs, params))
+
+def constDriver_fast (t, inputs, outputs, params):
+    return ([[], [params[0]-outputs[0]]])
+constDriver.prepare = check_once ('constDriver', 0,1,1, constDriver_fast)
 
 # Drive a node to a PWL sequence.
 # One output, which is the node to drive.
@@ -42,7 +91,6 @@ def constDriver (t, inputs, outputs, params):
 # concentration of 4 at t=0, 5 at t=2, interpolation for t in (0,2), and
 # a concentration of 5 for t>2.
 def pwl (t, inputs, outputs, params):
-    import numpy as np
     checkInputs ('pwl', 0,1,44, inputs, outputs, params)
     # Split the parameter list into arrays of time and concentration.
     tt = np.array (params[0::2])
@@ -52,9 +100,36 @@ def pwl (t, inputs, outputs, params):
     current=outputs[0]
     return ([ [], [10*(desired-current)] ])
 
+# A params list of (x,y) pairs as (a snapshot of the list, the x values, the
+# y values).
+def split_pairs (params):
+    return (tuple (params), np.array (params[0::2], dtype=float),
+            np.array (params[1::2], dtype=float))
+
+# Split the parameters only when they change: each call compares them to a
+# snapshot of the ones it last split, so that a params list edited in place
+# (or a different one) gets split afresh.
+def pwl_prepare (inputs, outputs, params):
+    checkInputs ('pwl', 0,1,44, inputs, outputs, params)
+    split = split_pairs (params)
+    assert ((split[1][0]==0) and (len(split[1])==len(split[2])))
+    def pwl_fast (t, inputs, outputs, prm):
+        nonlocal split
+        if (tuple (prm) != split[0]):
+            split = split_pairs (prm)
+            assert ((split[1][0]==0) and (len(split[1])==len(split[2])))
+        _, tt, yy = split
+        return ([ [], [10*(np.interp (t, tt, yy)-outputs[0])] ])
+    return (pwl_fast)
+pwl.prepare = pwl_prepare
+
+# The times where the drive has a corner; see "Breakpoints" above.
+def pwl_breakpoints (params):
+    return (params[2::2])
+pwl.breakpoints = pwl_breakpoints
+
 # An inverter whose Vout-vs-Vin transfer curve is pwl.
 def inv_pwl (t, inputs, outputs, params):
-    import numpy as np
     checkInputs ('inv_pwl', 1,1,44, inputs, outputs, params)
     # Split the parameter list into arrays of Cin and Cout.
     Cin  = np.array (params[0::2])
@@ -65,6 +140,21 @@ def inv_pwl (t, inputs, outputs, params):
     #print ('t=',t,': inv_pwl [in]=',inputs[0],', pwl=',val,"[out]'=",delta)
     return ([ [], [delta] ])
 
+# As for pwl, split the parameters only when they change.
+def inv_pwl_prepare (inputs, outputs, params):
+    checkInputs ('inv_pwl', 1,1,44, inputs, outputs, params)
+    split = split_pairs (params)
+    assert (len(split[1])==len(split[2]))
+    def inv_pwl_fast (t, inputs, outputs, prm):
+        nonlocal split
+        if (tuple (prm) != split[0]):
+            split = split_pairs (prm)
+            assert (len(split[1])==len(split[2]))
+        _, Cin, Cout = split
+        return ([ [], [np.interp (inputs[0], Cin, Cout) - outputs[0]] ])
+    return (inv_pwl_fast)
+inv_pwl.prepare = inv_pwl_prepare
+
 # Implement out=A*sin(w*t)+B
 # Assume w is in radians/sec.
 # Parameters are A, w, B.
@@ -74,7 +164,7 @@ def inv_pwl (t, inputs, outputs, params):
 def sin (t, inputs, outputs, params):
     checkInputs ('sin', 0,1,3, inputs, outputs, params)
     A, w, B = params;
-    return ([[], [A*w*cos(w*t)]])
+    return ([[], [A*w*np.cos(w*t)]])
 
 # Hill-function inverter.
 # TF = (in**n)/kDN
@@ -85,12 +175,15 @@ def sin (t, inputs, outputs, params):
 #	   [in]=inf => TF=inf => [out]=0
 # [out] is half of its max when kD=TF, or kD=(in^n)/kDN, or in=(kD*kDN)^(1/n)
 # Parameters are kP, kDP, kD, kDN, n.
-# inputs are the input and output.
+# One input and one output.
 def inv1(t, inputs, outputs, params):
     checkInputs ('invHill', 1,1,5, inputs, outputs, params)
+    return (inv1_fast (t, inputs, outputs, params))
+
+def inv1_fast (t, inputs, outputs, params):
     kP, kDP, kD, kDN, n = params
     TF = (inputs[0]**n) / kDN
-    return ([kP*kD/(kD+TF) - kDP*inputs[1]])
+    return ([[], [kP*kD/(kD+TF) - kDP*outputs[0]]])
     #Ksw = (kDN*kD)**(1/n)
     #print('Inv1 kDN=',kDN,'kD=',kD,'Ksw=',Ksw)
     #print ('t=',t,': inv',Q in=',inputs[1], ',', '=',inputs[0],'*='
@@ -104,26 +197,176 @@ def inv1(t, inputs, outputs, params):
 # [out] is half of its max when kD=TF, or kD=(in^n)/kDN, or in=(kD*kDN)^(1/n)
 def buf1(t, inputs, outputs, params):
     checkInputs ('bufHill', 1,1,5, inputs, outputs, params)
+    return (buf1_fast (t, inputs, outputs, params))
+
+def buf1_fast (t, inputs, outputs, params):
     kP, kDP, kD, kDN, n = params
     TF = (inputs[0]**n) / kDN
-    return ([kP*TF/(kD+TF) - kDP*inputs[1]])
+    return ([[], [kP*TF/(kD+TF) - kDP*outputs[0]]])
     #Ksw = (kDN*kD)**(1/n); print('Buf1 kDN=#d,kD=#d,Ksw=#d\n', kDN,kD,Ksw)
     #print ('t=#d: buf #s in=#d, #s=#d, #s*=#d.\n', t, inputs(1),inputs(2),Q,out(1))
 
 # "Implies" gate: out = !a | b.
 def imp1(t, inputs, outputs, params):
     checkInputs ('impliesHill', 2,1,5, inputs, outputs, params)
+    return (imp1_fast (t, inputs, outputs, params))
+
+def imp1_fast (t, inputs, outputs, params):
     kP, kDP, kD, kDN, n = params
     TFa = (inputs[0]**n) / kDN
     TFb = (inputs[1]**n) / kDN
-    return ([[], [kP*max(kD/(kD+TFa), TFb/(kD+TFb)) - kDP*outputs[0]]])
+    return ([[], [kP*np.maximum(kD/(kD+TFa), TFb/(kD+TFb)) - kDP*outputs[0]]])
     # print ('t=#d: imp #s A=#d,B=#d,#s=#d, TFa=#d,P1=#d,TFb=#d,P2=#d,D=#d, #s*=#d.\n', t, inputs(1),inputs(2),Q,inputs(3),TFa,(kD/(kD+TFa)),TFb,(TFb/(kD+TFb)),(kDP*inputs(3)),Q,out(1))
 
+inv1.prepare = check_once ('invHill', 1,1,5, inv1_fast)
+buf1.prepare = check_once ('bufHill', 1,1,5, buf1_fast)
+imp1.prepare = check_once ('impliesHill', 2,1,5, imp1_fast)
+
+########################################
+# Derivative hooks, used by sim_infrastructure.jacobian().
+# A gate 'g' may have an attribute g.jac, a function with the same arguments
+# as the gate. It returns [d_in, d_out]: the derivatives of the gate's input
+# slews and output slews with respect to [inputs..., outputs...]. So d_out has
+# one row per output and one column per input plus one per output; d_in is []
+# if the gate never slews its inputs.
+# Gates without a hook get differentiated numerically.
+#
+# A gate may also set g.batch = True, promising that it (and its .jac hook)
+# work unchanged when each entry of inputs[] and outputs[] is an array of
+# that metabolite's value in many replicas of the network, and likewise for
+# each entry of params[] (for ensembles whose replicas have their own
+# parameters). Ensembles (e.g., run_xfer_curve() and run_ensemble()) then
+# call it once for all of the replicas.
+########################################
+
+# d(TF)/d(in), where TF = (in^n)/kDN.
+def hill_dTF (x, kDN, n):
+    x = np.asarray (x, dtype=float)
+    with np.errstate (divide='ignore', invalid='ignore'):
+        d = n * x**(n-1) / kDN
+    return (np.where (x==0, np.where (n==1, 1/kDN, 0), d))
+
+def inv1_jac (t, inputs, outputs, params):
+    kP, kDP, kD, kDN, n = params
+    TF = (inputs[0]**n) / kDN
+    dIn = -kP*kD*hill_dTF(inputs[0],kDN,n) / (kD+TF)**2
+    return ([[], [[dIn, -kDP]]])
+inv1.jac = inv1_jac
+inv1.batch = True
+
+def buf1_jac (t, inputs, outputs, params):
+    kP, kDP, kD, kDN, n = params
+    TF = (inputs[0]**n) / kDN
+    dIn = kP*kD*hill_dTF(inputs[0],kDN,n) / (kD+TF)**2
+    return ([[], [[dIn, -kDP]]])
+buf1.jac = buf1_jac
+buf1.batch = True
+
+# Only the larger of the two terms in the max() contributes.
+def imp1_jac (t, inputs, outputs, params):
+    kP, kDP, kD, kDN, n = params
+    TFa = (inputs[0]**n) / kDN
+    TFb = (inputs[1]**n) / kDN
+    aWins = (kD/(kD+TFa) >= TFb/(kD+TFb))
+    dA = np.where (aWins, -kP*kD*hill_dTF(inputs[0],kDN,n) / (kD+TFa)**2, 0)
+    dB = np.where (aWins, 0, kP*kD*hill_dTF(inputs[1],kDN,n) / (kD+TFb)**2)
+    return ([[], [[dA, dB, -kDP]]])
+imp1.jac = imp1_jac
+imp1.batch = True
+
 # Always-on promoter.
 def constitutive (t, inputs, outputs, params):
     checkInputs ('constitutive', 0,1,1, inputs, outputs, params)
     return ([.05])
 
+# Reversible mass-action reaction: inputs <-> outputs.
+# The net forward rate is v = kF*prod(inputs) - kR*prod(outputs). Every output
+# gains v and every input loses v.
+# Any number of inputs and outputs; parameters are kF, kR.
+def mass_action (t, inputs, outputs, params):
+    checkInputs ('mass_action', len(inputs),len(outputs),2,
+                 inputs, outputs, params)
+    return (mass_action_fast (t, inputs, outputs, params))
+
+def mass_action_fast (t, inputs, outputs, params):
+    kF, kR = params
+    v = kF*np.prod(inputs) - kR*np.prod(outputs)
+    return ([[-v]*len(inputs), [v]*len(outputs)])
+mass_action.prepare = check_once ('mass_action', None,None,2, mass_action_fast)
+
+# Like mass_action(), but the inputs are assumed to have constant
+# concentration; e.g., mRNA + tRNA <-> mRNA.tRNA when some other process keeps
+# [mRNA] and [tRNA] fixed. So only the outputs change.
+def mass_action_held (t, inputs, outputs, params):
+    checkInputs ('mass_action_held', len(inputs),len(outputs),2,
+                 inputs, outputs, params)
+    return (mass_action_held_fast (t, inputs, outputs, params))
+
+def mass_action_held_fast (t, inputs, outputs, params):
+    kF, kR = params
+    v = kF*np.prod(inputs) - kR*np.prod(outputs)
+    return ([[], [v]*len(outputs)])
+mass_action_held.prepare = check_once ('mass_action_held', None,None,2,
+                                       mass_action_held_fast)
+
+########################################
+# Propensity hooks, used by sim_stochastic.
+# A gate 'g' may have an attribute g.propensity, a function with the same
+# arguments as the gate. It returns [up, down]: for each output, the rate at
+# which the output gains one molecule and at which it loses one. (In other
+# words, the gate's slew split into its production and decay terms.)
+########################################
+
+def inv1_propensity (t, inputs, outputs, params):
+    kP, kDP, kD, kDN, n = params
+    TF = (inputs[0]**n) / kDN
+    return ([[kP*kD/(kD+TF)], [kDP*outputs[0]]])
+inv1.propensity = inv1_propensity
+
+def buf1_propensity (t, inputs, outputs, params):
+    kP, kDP, kD, kDN, n = params
+    TF = (inputs[0]**n) / kDN
+    return ([[kP*TF/(kD+TF)], [kDP*outputs[0]]])
+buf1.propensity = buf1_propensity
+
+def imp1_propensity (t, inputs, outputs, params):
+    kP, kDP, kD, kDN, n = params
+    TFa = (inputs[0]**n) / kDN
+    TFb = (inputs[1]**n) / kDN
+    return ([[kP*np.maximum(kD/(kD+TFa), TFb/(kD+TFb))], [kDP*outputs[0]]])
+imp1.propensity = imp1_propensity
+
+# Delay line: out' = k*(in(t-delay) - out). So [out] tracks the input as it
+# was 'delay' time units ago, with time constant 1/k.
+# One input, one output; parameters are delay, k.
+# Before t=delay, it uses the earliest input it saw.
+# It keeps the input's history in the reaction's private space, so each
+# delay1 reaction must belong to only one network, and does not work in an
+# ensemble (e.g., run_xfer_curve()).
+def delay1 (t, inputs, outputs, params):
+    checkInputs ('delay1', 1,1,2, inputs, outputs, params)
+    return (delay1_fast (t, inputs, outputs, params))
+
+def delay1_fast (t, inputs, outputs, params):
+    import sim_infrastructure as si
+    delay, k = params
+    hist = si.read_my_space()
+    if (hist is None):
+        hist = si.StateHistory(); si.write_my_space (hist)
+    # The solver may try a big step and then back off, so keep much more
+    # history than the delay itself.
+    si.save_state_time (t, inputs[0], hist, 100*delay)
+    old = si.get_state_time (t-delay, hist, cubic=True)
+    return ([[], [k*(old - outputs[0])]])
+
+# The delayed input does not depend on the current state, so only the decay
+# term shows up in the Jacobian.
+def delay1_jac (t, inputs, outputs, params):
+    delay, k = params
+    return ([[], [[0, -k]]])
+delay1.jac = delay1_jac
+delay1.prepare = check_once ('delay1', 1,1,2, delay1_fast)
+
 def checkInputs (fName, nIn, nOut, nParam, In, out, param):
     if (nIn != len(In)):
         raise Exception ('Instance '+fName+' expects '+str(nIn)
@@ -0,0 +1,193 @@
+########################################
+# Quasi-steady-state reduction of the stiff networks built with
+# sim_infrastructure.
+# run_sim_reduced (tEnd, n_timepoints=10, method='auto', gap=100,
+#		   compare=True, net=None)
+#	run_sim() on a quasi-steady-state reduction of a stiff network. Each
+#	vectorized reaction's rate of relaxation at the initial state is
+#	found; if they split into fast and slow ones at least 'gap' times
+#	apart, only the pools of metabolites that the fast reactions leave
+#	alone (e.g., A+C and B+C for A+B <-> C) get integrated, and at every
+#	point the metabolites are set from the pools by an algebraic
+#	quasi-steady-state relation (d/dt=0 for an intermediate drained by a
+#	fast reaction, or equilibrium for a fast reversible one). Gated
+#	reactions always count as slow. Returns the timepoints, the results
+#	for every metabolite (as for run_sim()), and a report: a dict saying
+#	which reactions were fast and slow, the separation of their
+#	timescales and the time taken, and (with compare=True) the same run
+#	of the full network's time and the reduction's largest absolute and
+#	relative errors against it. The error is of the order of 1/separation,
+#	except at timepoints within a few times 1/(the fast reactions' rate)
+#	of the start, where the full network is still relaxing.
+#	Raises ValueError if there is no such separation.
+#	'net' is a sim_infrastructure.Network; by default, the one that
+#	add_metab() and add_reaction() built. Network.run_sim_reduced() and
+#	the module-level sim_infrastructure.run_sim_reduced() call this.
+########################################
+
+import numpy as np
+import sim_infrastructure as si
+
+# A quasi-steady-state reduction of a CompiledNetwork 'net'. Each vectorized
+# reaction j relaxes at the rate
+#	|sum_m d(v_j)/d(y_m) * stoich[m,j]|
+# at the state 'y', i.e., how fast its own flux undoes itself. Where those
+# rates split into fast and slow groups, at least 'gap' times apart, the
+# fast reactions relax almost at once, and from then on the state stays on
+# the slow manifold. Each fast reaction takes away one "fast" metabolite:
+# the ones that the fast reactions' fluxes depend on most (by a pivoted QR
+# of their partials), which relax with them. On the manifold
+#	d(fast)/dt = 0
+# which for a fast reaction that drains a lone intermediate is the classic
+# QSSA, and for a fast reversible one is (to first order) rapid
+# equilibrium. The fast reactions leave the "pools" z = L @ y alone
+# (the rows of L span the left null space of their stoichiometry; e.g.,
+# A+C and B+C for A+B <-> C), so the reduced system integrates just the
+# pools,
+#	dz/dt = L @ yprime(y)
+# and at every point finds the y on the manifold with those pools. Because
+# the manifold is solved for anew at each point, nonlinear fast reactions
+# are handled, and whatever the full network conserves, the pools conserve
+# exactly. The system is no longer stiff, and has the same rhs(),
+# jacobian() and jacobian_dense() as a CompiledNetwork, so integrate() can
+# run it; expand() turns its results back into every metabolite.
+# Only the vectorized reactions can be fast; the gated ones always count as
+# slow, whatever their rates. Which reactions are fast is decided once, from
+# the rates at 'y'.
+class ReducedNetwork:
+    def __init__ (self, net, y, t=0, gap=100):
+        import scipy.linalg
+        self.net = net
+        n = net.n_metabs
+        y = np.asarray (y, dtype=float)
+        S = net.stoich.toarray()
+
+        # Each vectorized reaction's relaxation rate, from the partials of
+        # its flux scattered onto the metabolites (dropping the padding).
+        idx = np.hstack ((net.in_idx, net.out_idx))
+        dv = np.zeros ((len(net.fast), n+1))
+        np.add.at (dv, (np.arange (len(net.fast))[:,np.newaxis], idx),
+                   net.rates_partials (y))
+        rate = np.abs ((dv[:,:n] * S.T).sum (axis=1))
+        order = np.argsort (-rate)
+        # Reactions that (almost) never relax, e.g. zero-order ones, are slow.
+        moving = order[rate[order] > 1e-9*max (rate.max(initial=0), 1e-300)]
+        ratios = rate[moving[:-1]] / rate[moving[1:]]
+        if ((len(ratios) == 0) or (ratios.max() < gap)):
+            raise ValueError ('QSSA: the network has no separation of '
+                              + 'timescales by a factor of '+str(gap))
+        m = int (np.argmax (ratios)) + 1
+        self.fast = np.sort (moving[:m])	# indices into net.fast
+        self.fast_rate = rate[moving[m-1]]	# the slowest fast reaction
+        self.slow_rate = rate[moving[m]]	# the fastest slow one
+
+        # The pools that the fast reactions keep, and the metabolites that
+        # relax with them.
+        Sf = S[:, self.fast]
+        self.L = scipy.linalg.null_space (Sf.T).T
+        k = Sf.shape[0] - self.L.shape[0]
+        _,_,perm = scipy.linalg.qr (dv[self.fast, :n], pivoting=True)
+        self.fast_metabs = np.sort (perm[:k])
+        self.n_metabs = self.L.shape[0]
+        self.y = y.copy()	# the last point on the manifold we found
+
+    # The full state on the slow manifold at time t whose pools are 'z':
+    # solve L @ y = z and yprime(y)[fast_metabs] = 0 by Newton's method,
+    # starting from the last point found.
+    def manifold (self, z, t):
+        y = self.y.copy()
+        for i in range (50):
+            g = np.concatenate ((self.L @ y - z,
+                                 self.net.rhs (y, t)[self.fast_metabs]))
+            M = np.vstack ((self.L,
+                            self.net.jacobian_dense (y, t)[self.fast_metabs]))
+            step = np.linalg.solve (M, g)
+            y -= step
+            if (np.all (np.abs(step) <= 1e-12*(1+np.abs (y)))):
+                self.y = y
+                return (y)
+        raise RuntimeError ('QSSA: could not solve for the fast species at t='
+                            + str(t))
+
+    # The pools of 'initVal', which the fast reactions keep as they relax.
+    def initial_state (self, initVal):
+        y = np.asarray (initVal, dtype=float)
+        self.y = y.copy()
+        return (self.L @ y)
+
+    def rhs (self, z, t):
+        return (self.L @ self.net.rhs (self.manifold (z, t), t))
+
+    # Along the manifold, L @ dy = dz and (J @ dy)[fast_metabs] = 0, so
+    # dy/dz is the first columns of the inverse of the Newton matrix.
+    def jacobian_dense (self, z, t):
+        y = self.manifold (z, t)
+        J = self.net.jacobian_dense (y, t)
+        k = self.n_metabs
+        M = np.vstack ((self.L, J[self.fast_metabs]))
+        return (self.L @ J @ np.linalg.solve (M, np.eye (len(y))[:, :k]))
+
+    def jacobian (self, z, t):
+        import scipy.sparse
+        return (scipy.sparse.csc_matrix (self.jacobian_dense (z, t)))
+
+    # Results Z of the slow system (one row per timepoint in timePts) as
+    # every metabolite.
+    def expand (self, Z, timePts):
+        return (np.array ([self.manifold (z, t) for z,t in zip (Z, timePts)]))
+
+# Run the simulation of run_sim() on a quasi-steady-state reduction of
+# the network (see ReducedNetwork), found from the reactions' rates at
+# the initial state: only the pools that the fast reactions leave alone
+# are integrated, and every metabolite is filled back in from them.
+# Returns the timepoints, the results for every metabolite (as for
+# run_sim(); the first row is the initial state, and the fast reactions
+# are relaxed from the next one on, so that any timepoints before the
+# full network has relaxed too are off by the relaxation) and a report,
+# a dict of
+#	fast, slow:	the names of the fast and the slow reactions.
+#	pools:		how many variables the reduced system integrates.
+#	separation:	how many times faster the slowest fast reaction is
+#			than the fastest slow one (at least 'gap').
+#	reduced_s:	the wall time for the reduced simulation.
+# With compare=True, it also runs the full network and adds
+#	full_s:		the wall time for that.
+#	max_abs_error:	the largest difference from it, over all metabolites
+#			and timepoints.
+#	max_rel_error:	the same, relative to the largest value of each
+#			metabolite.
+#	errors:		a dict of each metabolite's largest difference.
+def run_sim_reduced (tend, n_timepoints=10, method='auto', gap=100,
+                     compare=True, net=None):
+    import time
+    net = si.g_default if (net is None) else net
+    timePts = np.linspace (0, tend, n_timepoints)
+    comp = net.prepare()
+    method = net.pick_method (method)
+    start = time.perf_counter()
+    red = ReducedNetwork (comp, net.metab_initVal, 0, gap)
+    if (net.profile is not None):
+        net.profile.begin_run()
+    z = si.integrate (red, red.initial_state (net.metab_initVal), timePts,
+                      method, breaks=net.breakpoints())
+    y = red.expand (z, timePts)
+    if (net.profile is not None):
+        net.profile.end_run()
+    y[0] = net.metab_initVal	# before the fast species relax
+    fast = set (red.fast)
+    report = {'fast':[r.name for j,r in enumerate(comp.fast) if j in fast],
+              'slow':[r.name for j,r in enumerate(comp.fast)
+                      if j not in fast] + [r.name for r in comp.slow],
+              'pools':red.n_metabs,
+              'separation':float (red.fast_rate / red.slow_rate),
+              'reduced_s':time.perf_counter() - start}
+    if (compare):
+        start = time.perf_counter()
+        _,yFull = net.run_sim (tend, n_timepoints, method)
+        report['full_s'] = time.perf_counter() - start
+        err = np.abs (y - yFull).max (axis=0)
+        scale = np.maximum (np.abs (yFull).max (axis=0), 1e-300)
+        report['max_abs_error'] = float (err.max())
+        report['max_rel_error'] = float ((err/scale).max())
+        report['errors'] = dict (zip (net.metabs, err.tolist()))
+    return (timePts, y, report)
@@ -0,0 +1,273 @@
+########################################
+# Stochastic simulation of the networks built with sim_infrastructure.
+# run_ssa (tEnd, n_timepoints=10, n_runs=1, method='direct', volume=1,
+#	   eps=.03, seed=None, net=None)
+#	Simulate the network 'net' (by default, the one that add_metab() and
+#	add_reaction() built) n_runs times, as individual molecules.
+#	Concentrations are turned into molecule counts by multiplying by
+#	'volume' (and rounding), so volume=1 means that a concentration of 1 is
+#	one molecule.
+#	'method' is either
+#	- 'direct': Gillespie's exact direct method, or
+#	- 'tau': adaptive tau-leaping (Cao, Gillespie & Petzold, 2006). Each
+#	  leap fires a Poisson number of every reaction; 'eps' bounds how much
+#	  any propensity may change during a leap. When a leap would be shorter
+#	  than about 10 exact steps, it takes an exact step instead.
+#	  Near a steady state the propensities hardly drift, so that bound
+#	  alone allows leaps far longer than the network's relaxation time,
+#	  where an explicit leap is unstable and inflates the fluctuations
+#	  (for a birth-death process, its variance grows by a factor of
+#	  2/(2-k*tau), for decay rate k). So each leap is also held to at most
+#	  eps over the fastest relaxation rate, max over channels j of
+#	  sum_i |d a_j/d x_i|. That leaves the stationary variance about eps/2
+#	  too high (1.5% at the default eps), which is the price of leaping;
+#	  use 'direct' where the fluctuations must be exact.
+#	All of the runs advance together as a vectorized ensemble.
+#	Returns, like run_sim(), a 1D array of n_timepoints evenly-spaced
+#	times from 0 to tEnd, and the concentrations at those times; but the
+#	latter is a 3D array indexed [run, timepoint, metabolite].
+#
+# Where the propensities come from:
+#	- every mass_action, mass_action_held and constDriver reaction splits
+#	  into a forward and a reverse reaction, with the same rate constants
+#	  as the deterministic simulation. E.g., constDriver becomes production
+#	  at rate 'desired' and decay at rate 1 per molecule.
+#	- any other reaction function 'g' may have a hook g.propensity(t,
+#	  inputs, outputs, params), called with concentrations like the gate
+#	  itself. It returns [up, down]: for each output, the rate
+#	  (concentration/time) at which it gains one molecule and at which it
+#	  loses one. sim_library's Hill gates have one.
+#	- a reaction function without a hook is approximated from its slews:
+#	  a positive slew becomes the "up" rate and a negative one the "down"
+#	  rate. That is exact only for gates that purely produce or purely
+#	  remove each metabolite.
+########################################
+
+import numpy as np
+import sim_infrastructure as si
+
+# All of the reaction channels of a network: V[:,c] is the change in the
+# molecule counts when channel c fires once.
+class Channels:
+    def __init__ (self, net, volume):
+        comp = net.prepare()
+        self.comp = comp
+        self.volume = volume
+        n = comp.n_metabs
+        self.n_metabs = n
+
+        # The mass-action channels: each reaction forwards, then backwards.
+        idx = np.vstack ((pad_to (comp.in_idx,  n, comp.out_idx.shape[1]),
+                          pad_to (comp.out_idx, n, comp.in_idx.shape[1])))
+        self.idx = idx
+        self.k = np.concatenate ((comp.kF, comp.kR))
+        # A species that appears twice in one reaction needs X*(X-1), not
+        # X*X; 'offset' says how many earlier slots hold the same species.
+        self.offset = np.zeros (idx.shape)
+        for c in range(idx.shape[0]):
+            for s in range(idx.shape[1]):
+                if (idx[c,s] != n):
+                    self.offset[c,s] = np.sum (idx[c,:s] == idx[c,s])
+        # In molecule counts, a reaction of order m has rate constant
+        # k * volume^(1-m).
+        order = np.sum (idx != n, axis=1)
+        self.k_counts = self.k * float(volume)**(1-order)
+        S = comp.stoich.toarray()
+        V = [S, -S]
+
+        # Every other reaction gets an up and a down channel per output
+        # (and per input, if it slews its inputs and has no hook).
+        self.slow = comp.slow
+        for r in self.slow:
+            for m in r.outputs + ([] if hasattr (r.gate, 'propensity')
+                                  else r.inputs):
+                col = np.zeros ((n,1)); col[m] = 1
+                V.append (np.hstack ((col, -col)))
+        self.V = np.hstack (V)
+
+        # For choosing tau: the highest order of any channel that consumes
+        # each species (Cao et al.'s g_i), at least 1.
+        self.g = np.ones (n)
+        for c in range(idx.shape[0]):
+            for m in idx[c][idx[c] != n]:
+                if (self.V[m,c] < 0):
+                    self.g[m] = max (self.g[m], order[c])
+        # Which species each slow reaction's propensities read, and how many
+        # channels it has; for relaxation_rates().
+        self.slow_reads = [sorted (set (r.inputs + r.outputs))
+                           for r in self.slow]
+
+    # The propensity of every channel in every run; X is [run, metabolite]
+    # in molecule counts, and t has one time per run.
+    def propensities (self, X, t):
+        n_run = X.shape[0]
+        X1 = si.append_one (X)
+        A = [self.k_counts * np.maximum (X1[:, self.idx] - self.offset, 0)
+                             .prod(axis=-1)]
+        conc = X / self.volume
+        for r in self.slow:
+            up, down = slow_propensities (r, conc, t)
+            for i in range(len(up)):
+                A.append (self.volume * np.stack ((up[i], down[i]), axis=1))
+        return (np.maximum (np.hstack (A), 0))
+
+    # For each run, the fastest rate at which any channel's propensity
+    # responds to the counts: max over channels j of sum_i |d a_j/d x_i|.
+    # X is as for propensities(), and A its result. The mass-action channels
+    # are differentiated exactly; the others by moving each species they
+    # read by one molecule.
+    def relaxation_rates (self, X, t, A):
+        n = self.n_metabs
+        X1 = si.append_one (X)
+        F = np.maximum (X1[:, self.idx] - self.offset, 0)
+        rates = np.zeros (A.shape)
+        n_mass = len(self.k)
+        for s in range(self.idx.shape[1]):
+            if (np.all (self.idx[:,s] == n)):
+                continue
+            others = np.delete (F, s, axis=2).prod (axis=-1)
+            rates[:, :n_mass] += np.where (self.idx[:,s] != n,
+                                           self.k_counts * others, 0)
+        col = n_mass
+        conc = X / self.volume
+        for r,reads in zip (self.slow, self.slow_reads):
+            width = 2 * len (slow_propensities (r, conc, t)[0])
+            base = A[:, col:col+width]
+            for m in reads:
+                moved = conc.copy(); moved[:,m] += 1/self.volume
+                up, down = slow_propensities (r, moved, t)
+                now = self.volume * np.stack (
+                        [a for pair in zip (up, down) for a in pair], axis=1)
+                rates[:, col:col+width] += np.abs (np.maximum (now, 0) - base)
+            col += width
+        return (rates.max (axis=1))
+
+# Pad an index array out to 'width' slots with the padding index 'n'.
+def pad_to (idx, n, width):
+    width = max (width, idx.shape[1])
+    out = np.full ((idx.shape[0], width), n, dtype=np.intp)
+    out[:, :idx.shape[1]] = idx
+    return (out)
+
+# The [up, down] rates (per output, then per input if there is no hook) for
+# reaction 'r' in every run; each entry is an array with one value per run.
+def slow_propensities (r, conc, t):
+    n_run = conc.shape[0]
+    hook = getattr (r.gate, 'propensity', None)
+    if ((hook is not None) and getattr (r.gate, 'batch', False)):
+        si.g_current.reaction = r
+        up, down = hook (t, conc[:,r.inputs].T, conc[:,r.outputs].T, r.params)
+        return ([np.broadcast_to (u, (n_run,)) for u in up],
+                [np.broadcast_to (d, (n_run,)) for d in down])
+
+    up = []; down = []
+    for p in range(n_run):
+        si.g_current.reaction = r
+        ins = conc[p, r.inputs]; outs = conc[p, r.outputs]
+        if (hook is not None):
+            u, d = hook (t[p], ins, outs, r.params)
+        else:
+            in_slews, out_slews = r.func (t[p], ins, outs, r.params)
+            if (len(in_slews) == 0):
+                in_slews = np.zeros (len(r.inputs))
+            slews = np.concatenate ((out_slews, in_slews))
+            u = np.maximum (slews, 0); d = np.maximum (-slews, 0)
+        up.append (u); down.append (d)
+    return (list (np.array (up, dtype=float).T),
+            list (np.array (down, dtype=float).T))
+
+# Record the state X of each run in 'runs' at every sample time in
+# [T, Tnew) that it has not recorded yet.
+def record (out, nxt, timePts, runs, X, Tnew):
+    while (True):
+        due = (nxt[runs] < len(timePts))
+        due[due] = timePts[nxt[runs][due]] < Tnew[due]
+        if (not due.any()):
+            return
+        r = runs[due]
+        out[r, nxt[r]] = X[due]
+        nxt[r] += 1
+
+# One exact Gillespie step for each run in 'runs'; A are their propensities.
+def ssa_step (ch, X, T, runs, A, tEnd, out, nxt, timePts, rng):
+    a0 = A.sum (axis=1)
+    with np.errstate (divide='ignore'):
+        tau = np.where (a0 > 0, rng.exponential (size=len(runs)) / a0, np.inf)
+    Tnew = T[runs] + tau
+    record (out, nxt, timePts, runs, X[runs], Tnew)
+    fire = Tnew <= tEnd
+    c = (np.cumsum (A, axis=1) < (rng.random (len(runs)) * a0)[:,np.newaxis]
+         ).sum (axis=1)
+    c = np.minimum (c, A.shape[1]-1)
+    X[runs[fire]] += ch.V[:, c[fire]].T
+    T[runs] = np.minimum (Tnew, tEnd)
+
+# One tau-leap for each run in 'runs'; A are their propensities and tau the
+# leap lengths. A leap that would drive a count negative is retried with half
+# the tau.
+def leap_step (ch, X, T, runs, A, tau, tEnd, out, nxt, timePts, rng):
+    tau = np.minimum (tau, tEnd - T[runs])
+    todo = np.ones (len(runs), dtype=bool)
+    Xnew = X[runs].copy()
+    while (todo.any()):
+        K = rng.poisson (A[todo] * tau[todo][:,np.newaxis])
+        Xtry = X[runs[todo]] + K @ ch.V.T
+        ok = np.all (Xtry >= 0, axis=1)
+        sel = np.nonzero (todo)[0]
+        Xnew[sel[ok]] = Xtry[ok]
+        todo[sel[ok]] = False
+        tau[sel[~ok]] /= 2
+    Tnew = T[runs] + tau
+    record (out, nxt, timePts, runs, X[runs], Tnew)
+    X[runs] = Xnew
+    T[runs] = Tnew
+
+def run_ssa (tEnd, n_timepoints=10, n_runs=1, method='direct', volume=1,
+             eps=.03, seed=None, net=None):
+    if (method not in ('direct', 'tau')):
+        raise ValueError ('run_ssa: unknown method '+str(method))
+    net = si.g_default if (net is None) else net
+    ch = Channels (net, volume)
+    rng = np.random.default_rng (seed)
+
+    timePts = np.linspace (0, tEnd, n_timepoints)
+    X0 = np.round (np.array (net.metab_initVal, dtype=float) * volume)
+    X = np.tile (X0, (n_runs,1))
+    T = np.zeros (n_runs)
+    out = np.zeros ((n_runs, n_timepoints, ch.n_metabs))
+    nxt = np.zeros (n_runs, dtype=np.intp)	# next sample for each run
+
+    while (True):
+        runs = np.nonzero (T < tEnd)[0]
+        if (len(runs) == 0):
+            break
+        A = ch.propensities (X[runs], T[runs])
+        if (method == 'direct'):
+            ssa_step (ch, X, T, runs, A, tEnd, out, nxt, timePts, rng)
+            continue
+
+        # Cao et al.'s tau: small enough that no species' expected change
+        # (mu) or its standard deviation moves it by more than eps*x/g.
+        # And no longer than eps times the fastest relaxation time, for
+        # stability (see above).
+        a0 = A.sum (axis=1)
+        mu = A @ ch.V.T; sig2 = A @ (ch.V**2).T
+        bound = np.maximum (eps * X[runs] / ch.g, 1)
+        relax = ch.relaxation_rates (X[runs], T[runs], A)
+        with np.errstate (divide='ignore', invalid='ignore'):
+            tau = np.minimum (np.where (mu!=0, bound/np.abs(mu), np.inf),
+                              np.where (sig2!=0, bound**2/sig2, np.inf))
+            tau = np.minimum (tau.min (axis=1),
+                              np.where (relax!=0, eps/relax, np.inf))
+            exact = tau < 10/a0
+        if (exact.any()):
+            ssa_step (ch, X, T, runs[exact], A[exact], tEnd, out, nxt,
+                      timePts, rng)
+        if ((~exact).any()):
+            leap_step (ch, X, T, runs[~exact], A[~exact], tau[~exact], tEnd,
+                       out, nxt, timePts, rng)
+
+    # Anything not yet recorded is at (or after the last event before) tEnd.
+    for p in range(n_runs):
+        out[p, nxt[p]:] = X[p]
+    return (timePts, out / volume)
@@ -0,0 +1,95 @@
+########################################
+# Parameter sweeps over reaction networks, spread across processes.
+# run_sweep (builder, grid, outputs, tEndGuess=100, mode='restart',
+#	     workers=None, chunksize=None, stats=False)
+#	For each point of 'grid', makes a fresh sim_infrastructure.Network,
+#	calls builder(net, **point) to fill it in, runs net.steady_state_sim()
+#	and records the final value of each metabolite named in 'outputs'.
+#	'grid' is either
+#	- a dict of {paramName: list of values}, meaning every combination of
+#	  them (in the same order as nested for loops, first name outermost), or
+#	- a list of dicts, each one a point {paramName: value}.
+#	The points get farmed out to a ProcessPoolExecutor with 'workers'
+#	processes (the default is one per CPU), 'chunksize' points at a time.
+#	With workers=1, it all runs in this process instead.
+#	'builder' must be picklable, i.e., a function defined at the top level
+#	of some module (not a lambda and not in __main__ on Windows/macOS).
+#	Returns a numpy structured array in grid order; it has the shape of the
+#	grid for a dict, and is 1D for a list. Its fields are each parameter,
+#	each output, 't' (how long steady_state_sim() simulated) and 'OK'.
+#	A point that did not converge has OK=False; one whose builder or
+#	simulation raised an exception also has NaN for its outputs and t. Either
+#	way, the rest of the sweep carries on.
+#	With stats=True, it also has fields for each point's solver statistics
+#	(see sim_infrastructure.SolverStats): rhs_evals, jac_evals, steps and
+#	switches (-1 where the point failed), so that the points that were
+#	expensive, and why, can be picked out of the table.
+########################################
+
+import numpy as np
+import itertools
+
+# Expand 'grid' into a list of points (each a dict), plus the shape that the
+# results should have.
+def grid_points (grid):
+    if (isinstance (grid, dict)):
+        names = list (grid.keys())
+        points = [dict (zip (names, vals))
+                  for vals in itertools.product (*grid.values())]
+        return (points, tuple (len(v) for v in grid.values()))
+    points = list (grid)
+    return (points, (len(points),))
+
+# The SolverStats totals that run_sweep(stats=True) records.
+STATS = ('rhs_evals', 'jac_evals', 'steps', 'switches')
+
+# Simulate one point; this is what runs in the worker processes.
+# Returns (output values, t, OK, solver statistics); the statistics are a
+# list of the STATS totals, or None without stats.
+def sweep_point (job):
+    import sim_infrastructure as si
+    builder, point, outputs, tEndGuess, mode, stats = job
+    net = si.Network()
+    st = si.SolverStats() if stats else None
+    try:
+        builder (net, **point)
+        t,y,OK = net.steady_state_sim (tEndGuess, mode=mode, stats=st)
+        counts = [getattr (st, s) for s in STATS] if stats else None
+        return ([net.final_val (y, o) for o in outputs], t, bool(OK), counts)
+    except Exception as e:
+        print ('Sweep point', point, 'failed:', e)
+        return ([np.nan]*len(outputs), np.nan, False,
+                [-1]*len(STATS) if stats else None)
+
+def run_sweep (builder, grid, outputs, tEndGuess=100, mode='restart',
+               workers=None, chunksize=None, stats=False):
+    points, shape = grid_points (grid)
+    names = list (points[0].keys()) if (len(points) != 0) else []
+    jobs = [(builder, p, outputs, tEndGuess, mode, stats) for p in points]
+
+    if (workers == 1):
+        results = [sweep_point (j) for j in jobs]
+    else:
+        import os
+        from concurrent.futures import ProcessPoolExecutor
+        if (workers is None):
+            workers = os.cpu_count() or 1
+        if (chunksize is None):		# about 4 chunks per worker
+            chunksize = max (1, len(jobs) // (4*workers))
+        with ProcessPoolExecutor (workers) as pool:
+            results = list (pool.map (sweep_point, jobs, chunksize=chunksize))
+
+    fields = ([(n, float) for n in names] + [(o, float) for o in outputs]
+              + [('t', float), ('OK', bool)]
+              + ([(s, np.int64) for s in STATS] if stats else []))
+    table = np.zeros (len(points), dtype=fields)
+    for i,(p,(vals,t,OK,counts)) in enumerate (zip (points, results)):
+        for n in names:
+            table[n][i] = p[n]
+        for o,v in zip (outputs, vals):
+            table[o][i] = v
+        table['t'][i] = t; table['OK'][i] = OK
+        if (stats):
+            for s,c in zip (STATS, counts):
+                table[s][i] = c
+    return (table.reshape (shape))